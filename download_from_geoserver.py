@@ -3,6 +3,9 @@ Download any dataset from a Geoserver installation.
 * The dataset can be filtered before download.
 * You can choose any CRS.
 * Valid formats are "text/csv", "application/zip", "application/json"
+* JSON results can be cached on disk in a binary format so that later runs don't have to download and parse them again.
+* For JSON, a cheap 'resultType=hits' request tells us how big the result is and we pick a download plan to suit: one
+  request, pages one after another, or tiles fetched in parallel. See 'plan_download'.
 
 To use just import 'download_wfs_data' into your program. You can run this program stand-alone as well for testing
 purposes.
@@ -13,11 +16,18 @@ April 2021
 
 # If any of these imports fail, it's likely to be because you haven't installed the appropriate library.
 try:
+    import math
+    import re
+    import struct
+    from concurrent.futures import ThreadPoolExecutor
     from io import BytesIO
     from zipfile import ZipFile
     import urllib
     import requests
     from owslib.wfs import WebFeatureService
+    import utilities.parsed_dataset_cache as pdc
+    import utilities.fiona_supported_drivers as fsd
+    from utilities.get_or_create_temporary_directory import CacheManager
 except Exception as e:
     print(f"{e}")
     quit(1)
@@ -25,9 +35,281 @@ except Exception as e:
 # Default host, it's unlikely that you'll need to change this.
 HOST = "https://markfoley.info/geoserver"
 
+# When to stop using one request and start paging or tiling, how big a page is and which attribute to order pages by
+# (None means the first attribute in the schema). Override any of these with the 'thresholds' argument of
+# 'download_wfs_data'.
+DEFAULT_THRESHOLDS = {
+    "single_max": 10000,
+    "paged_max": 200000,
+    "page_size": 10000,
+    "workers": 4,
+    "sort_by": None
+}
+STRATEGIES = ("auto", "single", "paged", "tiled")
+
+
+def build_getfeature_url(host=HOST, workspace=None, dataset=None, output_format="application/json", srs=None,
+                         filter_expression=None, property_list=None, extra_parameters=None, version="1.0.0"):
+    """
+    Make a WFS GetFeature URL. Parameters are the same as 'download_wfs_data'.
+
+    :param extra_parameters: dict of any other WFS parameters to add, e.g. {"maxFeatures": 10}.
+    :param version: WFS version.
+    :return: URL as str
+    """
+    if isinstance(property_list, str):
+        property_list = property_list.split(",")
+
+    # Strings to supply to URL. Note that (E)CQL and propertyName expressions must be URL-encoded.
+    cql_string = f"&cql_filter={urllib.parse.quote(filter_expression)}" if filter_expression else ""
+    property_string = f"&propertyName={urllib.parse.quote(','.join(property_list))}" if property_list else ""
+    srs_string = f"&srsName=EPSG:{srs}" if srs else ""
+    format_string = f"&outputFormat={output_format}" if output_format else ""
+    extra_string = "".join(f"&{k}={urllib.parse.quote(str(v))}" for k, v in (extra_parameters or {}).items())
+
+    return f"{host}/{workspace}/ows?service=WFS&version={version}&request=GetFeature" \
+           f"&typeName={workspace}:{dataset}{cql_string}{property_string}{srs_string}{format_string}{extra_string}"
+
+
+def combine_filters(*expressions):
+    """
+    AND together any number of CQL expressions, ignoring empty ones.
+
+    :return: CQL expression or None
+    """
+    expressions = [e for e in expressions if e]
+    if len(expressions) < 2:
+        return expressions[0] if expressions else None
+    return " AND ".join(f"({e})" for e in expressions)
+
+
+def count_features(host=HOST, workspace=None, dataset=None, filter_expression=None):
+    """
+    Ask Geoserver how many features match, without downloading them (WFS 1.1.0 resultType=hits).
+
+    :return: number of features or None if the server wouldn't say.
+    """
+    url = build_getfeature_url(host, workspace, dataset, None, None, filter_expression,
+                               extra_parameters={"resultType": "hits"}, version="1.1.0")
+    response = requests.get(url)
+    if not 200 <= response.status_code <= 299:
+        return None
+    found = re.search(r'number(?:OfFeatures|Matched)="(\d+)"', response.text)
+    return int(found.group(1)) if found else None
+
+
+def plan_download(host=HOST, workspace=None, dataset=None, filter_expression=None, strategy="auto", thresholds=None,
+                  wfs=None, sort_by=None):
+    """
+    Decide how to download a JSON result.
+    * single - one GetFeature request, as always. Used for small results or if we can't count the features.
+    * paged - one page of 'page_size' features after another (startIndex/maxFeatures).
+    * tiled - the layer's extent is cut into tiles which are fetched (and paged if necessary) in parallel.
+
+    :param strategy: "auto" to choose from the feature count, or force "single", "paged" or "tiled".
+    :param thresholds: dict overriding any of DEFAULT_THRESHOLDS.
+    :param wfs: OWSlib WebFeatureService for the host, if you already have one. Only needed for tiling.
+    :param sort_by: attribute to order pages by, so that pages don't overlap or skip features. Used if thresholds
+    doesn't set one.
+    :return: dict with strategy, estimated_count, requests (None if unknown), page_size, workers, sort_by, extent and
+    tiles (WGS84 bounding boxes, tiled only).
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Strategy must be one of {STRATEGIES}")
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    page_size = thresholds["page_size"]
+    plan = {"strategy": "single", "estimated_count": None, "requests": 1, "page_size": page_size,
+            "workers": thresholds["workers"], "sort_by": thresholds["sort_by"] or sort_by, "extent": None,
+            "tiles": None}
+    if strategy == "single":
+        return plan
+
+    count = count_features(host, workspace, dataset, filter_expression)
+    plan["estimated_count"] = count
+    if strategy == "auto":
+        if count is None or count <= thresholds["single_max"]:
+            return plan
+        strategy = "paged" if count <= thresholds["paged_max"] else "tiled"
+
+    plan["strategy"] = strategy
+    if strategy == "paged":
+        plan["requests"] = math.ceil(count / page_size) if count is not None else None
+        plan["workers"] = 1
+    else:
+        # Aim for about one page per tile. Features aren't spread evenly so some tiles will need more than one.
+        wfs = wfs or WebFeatureService(url=f"{host}/wfs", version='1.1.0')
+        min_x, min_y, max_x, max_y = wfs.contents[f"{workspace}:{dataset}"].boundingBoxWGS84[:4]
+        plan["extent"] = [min_x, min_y, max_x, max_y]
+        side = max(2, math.ceil(math.sqrt(math.ceil((count or 0) / page_size))))
+        width, height = (max_x - min_x) / side, (max_y - min_y) / side
+        plan["tiles"] = [[min_x + i * width, min_y + j * height, min_x + (i + 1) * width, min_y + (j + 1) * height]
+                         for j in range(side) for i in range(side)]
+        plan["requests"] = len(plan["tiles"])
+
+    return plan
+
+
+def _get_json(url):
+    response = requests.get(url)
+    if not 200 <= response.status_code <= 299:
+        raise ValueError(f"Bad status code: {response.status_code}")
+    return response.json()
+
+
+class _FeatureMerger:
+    # Put several GeoJSON responses back together. Features on a tile edge come back from both tiles, and a page can
+    # repeat features from the one before it, so we drop any feature id we've already seen.
+
+    def __init__(self):
+        self.collection = None
+        self.features = []
+        self.seen = set()
+
+    def add(self, page):
+        """
+        :return: number of features that we hadn't seen before
+        """
+        if self.collection is None:
+            self.collection = {k: v for k, v in page.items()
+                               if k not in ("features", "totalFeatures", "numberMatched", "numberReturned", "bbox")}
+        added = 0
+        for feature in page.get("features", []):
+            feature_id = feature.get("id")
+            if feature_id is not None:
+                if feature_id in self.seen:
+                    continue
+                self.seen.add(feature_id)
+            self.features.append(feature)
+            added += 1
+        return added
+
+    def result(self):
+        collection = dict(self.collection or {"type": "FeatureCollection"})
+        collection["features"] = self.features
+        collection["totalFeatures"] = len(self.features)
+        return collection
+
+
+def _iter_pages(page_size, merger, estimated_count=None, sort_by=None, **query):
+    # Page through the result, moving on by the number of features the server actually sent (it may cap a page
+    # below 'page_size'). We stop at an empty page, at a page with nothing new (e.g. a server that ignores
+    # startIndex) or once we have as many features as Geoserver said there were. Each page is yielded with just the
+    # features we hadn't seen before.
+    extra = {"sortBy": sort_by} if sort_by else {}
+    start = 0
+    target = len(merger.features) + estimated_count if estimated_count is not None else None
+    while True:
+        page = _get_json(build_getfeature_url(
+            extra_parameters=dict(extra, startIndex=start, maxFeatures=page_size), version="1.1.0", **query
+        ))
+        returned = len(page.get("features", []))
+        added = merger.add(page) if returned else 0
+        if not added:
+            return
+        yield dict(page, features=merger.features[-added:])
+        if target is not None and len(merger.features) >= target:
+            return
+        start += returned
+
+
+def _fetch_pages(page_size, merger, estimated_count=None, sort_by=None, **query):
+    for _ in _iter_pages(page_size, merger, estimated_count, sort_by, **query):
+        pass
+
+
+def _check_count(merger, plan):
+    if plan["estimated_count"] is not None and len(merger.features) < plan["estimated_count"]:
+        raise ValueError(f"Geoserver said there were {plan['estimated_count']} features but we only got "
+                         f"{len(merger.features)}.")
+
+
+def _fetch_paged(plan, filter_expression, **query):
+    merger = _FeatureMerger()
+    _fetch_pages(plan["page_size"], merger, plan["estimated_count"], plan["sort_by"],
+                 filter_expression=filter_expression, **query)
+    _check_count(merger, plan)
+    return merger.result()
+
+
+def _fetch_tiles(plan, geometry_column, filter_expression, **query):
+    def fetch_tile(tile):
+        bbox = f"BBOX({geometry_column}, {tile[0]}, {tile[1]}, {tile[2]}, {tile[3]}, 'EPSG:4326')"
+        tile_merger = _FeatureMerger()
+        _fetch_pages(plan["page_size"], tile_merger, sort_by=plan["sort_by"],
+                     filter_expression=combine_filters(filter_expression, bbox), **query)
+        return tile_merger.result()
+
+    merger = _FeatureMerger()
+    with ThreadPoolExecutor(max_workers=plan["workers"]) as executor:
+        for page in executor.map(fetch_tile, plan["tiles"]):
+            merger.add(page)
+
+    # The tiles only cover the extent in the capabilities document. Pick up anything outside it (the extent may be
+    # out of date) and anything with no geometry at all.
+    if plan["estimated_count"] is None or len(merger.features) < plan["estimated_count"]:
+        extent = plan["extent"]
+        outside = f"NOT BBOX({geometry_column}, {extent[0]}, {extent[1]}, {extent[2]}, {extent[3]}, 'EPSG:4326') " \
+                  f"OR {geometry_column} IS NULL"
+        _fetch_pages(plan["page_size"], merger, sort_by=plan["sort_by"],
+                     filter_expression=combine_filters(filter_expression, outside), **query)
+    _check_count(merger, plan)
+    return merger.result()
+
+
+def _get_schema(host, workspace, dataset, property_list):
+    # Returns the OWSlib WebFeatureService, the schema, the property list to ask for and an attribute to sort pages by.
+
+    # Create an OWSlib WebFeatureService object and get the relevant schema
+    wfs11 = WebFeatureService(url=f"{host}/wfs", version='1.1.0')
+    this_schema = wfs11.get_schema(f"{workspace}:{dataset}")
+    # Pages need a stable order. Sort on the first attribute unless 'thresholds' says otherwise; Geoserver breaks
+    # ties on the primary key.
+    sort_by = next(iter(this_schema["properties"]), None)
+
+    # If we have a properties filter, we adjust the schema to reflect this. We need to add the geometry column
+    # otherwise we won't get the feature geometries.
+    if property_list:
+        # Work on a copy so that we don't change the caller's list.
+        property_list = property_list.split(",") if isinstance(property_list, str) else list(property_list)
+        required_properties = {k: v for k, v in this_schema["properties"].items() if k in property_list}
+        if required_properties:
+            property_list.append(this_schema["geometry_column"])
+            this_schema["properties"] = required_properties
+
+    # OWSlib 'get_schema' is a mess so we fix it.
+    this_schema["properties"] = fsd.fiona_property_types(this_schema["properties"])
+
+    return wfs11, this_schema, property_list, sort_by
+
+
+def iter_wfs_pages(host=HOST, workspace=None, dataset=None, srs=None, filter_expression=None, property_list=None,
+                   thresholds=None):
+    """
+    Download a JSON result a page at a time, so that you can start on the features before the download has finished
+    (see run_pipeline.py). Pages are fetched the same way as the "paged" strategy of 'download_wfs_data', and we raise
+    if we end up with fewer features than Geoserver counted.
+
+    :param thresholds: overrides for DEFAULT_THRESHOLDS, only 'page_size' and 'sort_by' are used.
+    :return: tuple of the schema and a generator of GeoJSON FeatureCollections (dicts), one per page. The schema is
+    fetched straight away, the pages as you go through the generator.
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    _, this_schema, property_list, sort_by = _get_schema(host, workspace, dataset, property_list)
+    estimated_count = count_features(host, workspace, dataset, filter_expression)
+
+    def pages():
+        merger = _FeatureMerger()
+        yield from _iter_pages(thresholds["page_size"], merger, estimated_count, thresholds["sort_by"] or sort_by,
+                               host=host, workspace=workspace, dataset=dataset, output_format="application/json",
+                               srs=srs, filter_expression=filter_expression, property_list=property_list)
+        _check_count(merger, {"estimated_count": estimated_count})
+
+    return this_schema, pages()
+
 
 def download_wfs_data(host=HOST, workspace=None, dataset=None, output_format="application/json", srs=None,
-                      filter_expression=None, property_list=None, return_directory=None):
+                      filter_expression=None, property_list=None, return_directory=None, cache_directory=None,
+                      strategy="auto", thresholds=None, lazy=False):
     """
     This is the main 'active ingredient' in this process. You import this into your program and provide the necessary
     parameters. Note that some have defaults (which can be None).
@@ -41,49 +323,72 @@ def download_wfs_data(host=HOST, workspace=None, dataset=None, output_format="ap
     :param property_list: You can select a subset of non-spatial properties to download.
     :param return_directory: Only relevant to Zip files. This is where the contents of a zipfile will be stored. Used
     when you want to get shapefiles.
+    :param cache_directory: Only relevant to JSON. A directory or a 'CacheManager'. If supplied, the parsed result is
+    saved here and later calls with the same host, workspace, dataset, filter, properties and SRS load it from disk
+    instead of going to Geoserver. Pass a 'CacheManager' to share the cache between processes with a size limit.
+    :param strategy: Only relevant to JSON. "auto" (the default) counts the features first and picks "single", "paged"
+    or "tiled" to suit; or force one of these. See 'plan_download'.
+    :param thresholds: Only relevant to JSON. Overrides for DEFAULT_THRESHOLDS.
+    :param lazy: Only relevant to a result loaded from the cache. The features are a 'ParsedFeatures' (see
+    parsed_dataset_cache.py) that decodes each feature as you use it, which makes loading much quicker if you don't
+    need every feature, or only need some columns.
 
     :return: The result. Content depends on output format.
     * Zip returns a tuple of directory (location) and a list of files.
     * CSV returns data in text format
     * Json returns a dictionary with schema and GeoJSON data. (This is the default). Note that we return a schema that
       matches the JSON data structure. How you choose to use this is up to you. but it would be useful if you just
-      wanted to create a shapefile from the GeoJSON data.
+      wanted to create a shapefile from the GeoJSON data. There's also 'plan', which tells you the estimated feature
+      count and how the data was fetched (not present if the result came from the cache).
     """
 
     valid_formats = ["text/csv", "application/zip", "application/json"]
 
     try:
-        # Create an OWSlib WebFeatureService object and get the relevant schema
-        wfs11 = WebFeatureService(url=f"{HOST}/wfs", version='1.1.0')
-        this_schema = wfs11.get_schema(f"{workspace}:{dataset}")
-
-        # If we have a properties filter, we adjust the schema to reflect this. We need to add the geometry column
-        # otherwise we won't get the feature geometries.
-        if property_list:
-            if isinstance(property_list, str):
-                property_list = property_list.split(",")
-            required_properties = {k: v for k, v in this_schema["properties"].items() if k in property_list}
-            if required_properties:
-                property_list.append(this_schema["geometry_column"])
-                this_schema["properties"] = required_properties
-
-        # OWSlib 'get_schema' is a mess so we fix it.
-        for k in this_schema["properties"]:
-            if this_schema["properties"][k] == "string":
-                this_schema["properties"][k] = "str"
-            elif this_schema["properties"][k] == "decimal":
-                this_schema["properties"][k] = "float"
-            elif this_schema["properties"][k] == "double":
-                this_schema["properties"][k] = "float"
-
-        # Strings to supply to URL. Note that (E)CQL and propertyName expressions must be URL-encoded.
-        cql_string = f"&cql_filter={urllib.parse.quote(filter_expression)}" if filter_expression else ""
-        property_string = f"&propertyName={urllib.parse.quote(','.join(property_list))}" if property_list else ""
-        srs_string = f"&srsName=EPSG:{srs}" if srs else ""
-        format_string = f"&outputFormat={output_format}" if output_format else ""
-
-        url = f"{host}/{workspace}/ows?service=WFS&version=1.0.0&request=GetFeature" \
-              f"&typeName={workspace}:{dataset}{cql_string}{property_string}{srs_string}{format_string}"
+        # If we've already parsed this exact query, load it from the cache. We work out the key before we touch
+        # 'property_list' as it gets changed below.
+        cache = None
+        if cache_directory and output_format == "application/json":
+            cache = cache_directory if isinstance(cache_directory, CacheManager) else CacheManager(cache_directory)
+            cache_key = f"{pdc.dataset_cache_key(host, workspace, dataset, filter_expression, property_list, srs)}." \
+                        f"{pdc.FILE_EXTENSION}"
+            cache_file = cache.get(pdc.CACHE_NAMESPACE, cache_key)
+            if cache_file:
+                try:
+                    return pdc.read_parsed_dataset(cache_file, lazy=lazy)
+                except FileNotFoundError:
+                    # Another process evicted it in the meantime, so just download it again.
+                    pass
+                except (ValueError, KeyError, IndexError, struct.error):
+                    # Not a file we can read (old format, other byte order, cut short...). Get rid of it, otherwise
+                    # we'd fail on it every time, and download again.
+                    cache.remove(pdc.CACHE_NAMESPACE, cache_key)
+
+        wfs11, this_schema, property_list, sort_by = _get_schema(host, workspace, dataset, property_list)
+
+        url = build_getfeature_url(host, workspace, dataset, output_format, srs, filter_expression, property_list)
+
+        # Work out how to fetch the data. Only JSON can be put back together from several requests.
+        if output_format == "application/json":
+            plan = plan_download(host, workspace, dataset, filter_expression, strategy, thresholds, wfs=wfs11,
+                                 sort_by=sort_by)
+        else:
+            plan = plan_download(strategy="single")
+        if plan["strategy"] != "single":
+            query = dict(host=host, workspace=workspace, dataset=dataset, output_format=output_format, srs=srs,
+                         property_list=property_list)
+            if plan["strategy"] == "paged":
+                geojson_data = _fetch_paged(plan, filter_expression, **query)
+            else:
+                geojson_data = _fetch_tiles(plan, this_schema["geometry_column"], filter_expression, **query)
+            result = {
+                "schema": this_schema,
+                "geojson_data": geojson_data,
+                "plan": plan
+            }
+            if cache:
+                cache.put(pdc.CACHE_NAMESPACE, cache_key, writer=lambda path: pdc.write_parsed_dataset(path, result))
+            return result
 
         response = requests.get(url)
         if 200 <= response.status_code <= 299:
@@ -100,10 +405,15 @@ def download_wfs_data(host=HOST, workspace=None, dataset=None, output_format="ap
                 my_zipfile.extractall(path=return_directory)
                 return return_directory, my_zipfile.namelist()
             if content_type[0][0] == "application/json":
-                return {
+                result = {
                     "schema": this_schema,
-                    "geojson_data": response.json()
+                    "geojson_data": response.json(),
+                    "plan": plan
                 }
+                if cache:
+                    cache.put(pdc.CACHE_NAMESPACE, cache_key,
+                              writer=lambda path: pdc.write_parsed_dataset(path, result))
+                return result
             if content_type[0][0] == "text/csv":
                 return response.text
             else:
@@ -0,0 +1,279 @@
+"""
+What can Fiona actually do on this machine?
+
+fiona_supported_drivers.py is a fixed list of drivers and file extensions. What a driver can do depends on the GDAL that
+Fiona was built against, so here we ask at run time:
+* 'probe_driver_capabilities' starts from 'fiona.supported_drivers' (read, append, write) and, if asked, checks that
+  writing and appending really work by doing it in a temporary directory.
+* 'benchmark_drivers' writes and reads the same synthetic data with each driver and measures throughput and file size.
+* 'choose_fastest_driver' picks the quickest driver that works, which 'write_spatial' uses for driver="auto".
+* 'can_write' is the cheap check 'write_spatial' makes on every call.
+
+Results are kept for the life of the process, so the probing and benchmarking are only done once.
+"""
+
+# If any of these imports fail, it's likely to be because you haven't installed the appropriate library.
+try:
+    import os
+    import tempfile
+    import time
+    import fiona
+    from fiona.crs import from_epsg
+    import utilities.fiona_supported_drivers as fsd
+except Exception as e:
+    print(f"{e}")
+    quit(1)
+
+# Synthetic data used for probing and benchmarking.
+TEST_SCHEMA_PROPERTIES = {"id": "int", "value": "float", "name": "str"}
+TEST_EPSG = 2157
+
+_capabilities = {}
+_benchmarks = {}
+
+
+def _synthetic_value(kind, i):
+    # A value for a Fiona property type such as "int", "str:80" or "float:24.15". OWSlib names work too.
+    kind = fsd.FIONA_TYPES.get(kind.split(":")[0], kind.split(":")[0])
+    if kind in ("int", "int32", "int64", "long"):
+        return i
+    if kind == "float":
+        return i * 0.5
+    if kind == "bool":
+        return bool(i % 2)
+    if kind == "date":
+        return "2020-01-01"
+    if kind == "datetime":
+        return "2020-01-01T12:00:00"
+    if kind == "time":
+        return "12:00:00"
+    return f"feature {i}"
+
+
+def synthetic_features(count, geometry_type="Point", properties=None):
+    """
+    Make 'count' GeoJSON features on a grid of 1km squares in ITM.
+
+    :param count: number of features
+    :param geometry_type: any of the GeoJSON single or multi geometry types
+    :param properties: dict of property name to Fiona type, defaults to TEST_SCHEMA_PROPERTIES.
+    :return: list of features as dicts
+    """
+    properties = properties or TEST_SCHEMA_PROPERTIES
+    if geometry_type.replace("Multi", "") not in ("Point", "LineString", "Polygon"):
+        raise ValueError(f"Can't make synthetic '{geometry_type}' data.")
+
+    features = []
+    for i in range(count):
+        x, y = 500000.0 + (i % 300) * 1000.0, 600000.0 + (i // 300) * 1000.0
+        ring = [[x, y], [x + 900.0, y], [x + 900.0, y + 900.0], [x, y + 900.0], [x, y]]
+        coordinates = {
+            "Point": [x, y],
+            "LineString": ring[:3],
+            "Polygon": [ring]
+        }[geometry_type.replace("Multi", "")]
+        if geometry_type.startswith("Multi"):
+            coordinates = [coordinates]
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": geometry_type, "coordinates": coordinates},
+            "properties": {name: _synthetic_value(kind, i) for name, kind in properties.items()}
+        })
+    return features
+
+
+def _meta(driver, geometry_type, properties=None):
+    return {
+        "driver": driver,
+        "crs": from_epsg(TEST_EPSG),
+        "schema": {"geometry": geometry_type,
+                   "properties": fsd.fiona_property_types(properties or TEST_SCHEMA_PROPERTIES)}
+    }
+
+
+def _directory_size(directory):
+    # Some drivers write more than one file (.shp, .shx, .dbf...) so we add them all up.
+    return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+
+def _try_write(driver, extension, append):
+    # Returns (write ok, append ok or None, error message or None).
+    with tempfile.TemporaryDirectory() as directory:
+        target = os.path.join(directory, f"probe.{extension}")
+        features = synthetic_features(3)
+        try:
+            with fiona.open(target, "w", **_meta(driver, "Point")) as fh:
+                fh.writerecords(features[:2])
+        except Exception as e:
+            return False, None, f"{e}"
+        if not append:
+            return True, None, None
+        try:
+            with fiona.open(target, "a") as fh:
+                fh.writerecords(features[2:])
+            with fiona.open(target, "r") as fh:
+                return True, len(list(fh)) == 3, None
+        except Exception as e:
+            return True, False, f"{e}"
+
+
+def probe_driver_capabilities(verify=True, refresh=False):
+    """
+    Find out what each driver can do.
+
+    :param verify: actually write (and append to) a small file with each driver that claims it can.
+    :param refresh: ignore results from an earlier call.
+    :return: dict of driver name to a dict of capabilities:
+    * read, append, write - what 'fiona.supported_drivers' says
+    * extension - file extension from fiona_supported_drivers.py, None if we don't know one
+    * write_verified, append_verified - whether writing/appending worked (None if not tried)
+    * stream - features can be added to an existing file batch by batch, i.e. appending works
+    * error - the error from the probe, if any
+    """
+    key = bool(verify)
+    if _capabilities.get(key) and not refresh:
+        return _capabilities[key]
+
+    capabilities = {}
+    for driver, modes in fiona.supported_drivers.items():
+        extension = fsd.file_extensions.get(driver)
+        entry = {
+            "read": "r" in modes,
+            "append": "a" in modes,
+            "write": "w" in modes,
+            "extension": extension,
+            "write_verified": None,
+            "append_verified": None,
+            "stream": "a" in modes,
+            "error": None
+        }
+        if verify and entry["write"] and extension:
+            entry["write_verified"], entry["append_verified"], entry["error"] = \
+                _try_write(driver, extension, entry["append"])
+            entry["stream"] = bool(entry["append_verified"])
+        capabilities[driver] = entry
+
+    _capabilities[key] = capabilities
+    return capabilities
+
+
+def can_write(driver):
+    """
+    Can we write files with this driver here? This only asks 'fiona.supported_drivers' (once per process), it doesn't
+    write anything. The probe writes our synthetic schema, which drivers with a fixed schema such as DXF or GPX reject
+    even though they'd take yours, so use 'probe_driver_capabilities' yourself if you want to check for real.
+
+    :param driver: Fiona driver name
+    :return: bool
+    """
+    entry = probe_driver_capabilities(verify=False).get(driver)
+    return bool(entry and entry["write"] and entry["extension"])
+
+
+def _first_position(geometry):
+    coordinates = geometry["coordinates"]
+    while coordinates and isinstance(coordinates[0], (list, tuple)):
+        coordinates = coordinates[0]
+    return coordinates
+
+
+def _check_round_trip(written, read_back, properties, read_properties):
+    # Raise if anything we care about didn't survive being written and read back: the number of features, their
+    # geometries (some drivers, e.g. CSV without the GEOMETRY option, quietly drop them) and the property names.
+    if len(read_back) != len(written):
+        raise ValueError(f"Wrote {len(written)} features but read back {len(read_back)}.")
+    missing = {name.lower() for name in properties} - {name.lower() for name in read_properties}
+    if missing:
+        raise ValueError(f"Lost properties {sorted(missing)}.")
+    for i in {0, len(written) // 2, len(written) - 1} if written else ():
+        before, after = written[i]["geometry"], read_back[i].get("geometry")
+        if not after or after["type"].replace("Multi", "") != before["type"].replace("Multi", ""):
+            raise ValueError(f"Geometry of feature {i} didn't survive: {after}")
+        if any(abs(a - b) > 1e-3 for a, b in zip(_first_position(before), _first_position(after))):
+            raise ValueError(f"Coordinates of feature {i} changed.")
+
+
+def benchmark_drivers(drivers=None, feature_count=10000, geometry_type="Point", refresh=False, properties=None):
+    """
+    Write and then read the same synthetic features with each driver. A driver only passes if the features, their
+    geometries and their property names all come back.
+
+    :param drivers: list of driver names, defaults to every driver we can write with.
+    :param feature_count: number of features to write
+    :param geometry_type: geometry type of the synthetic features
+    :param refresh: ignore results from an earlier call with the same arguments.
+    :param properties: dict of property name to Fiona type, i.e. your schema["properties"]. Defaults to
+    TEST_SCHEMA_PROPERTIES.
+    :return: list of dicts, fastest writer first, with driver, write_seconds, read_seconds,
+    write_features_per_second, read_features_per_second, bytes and error (None if all went well).
+    """
+    if drivers is None:
+        drivers = [d for d in probe_driver_capabilities(verify=False) if can_write(d)]
+    properties = dict(properties or TEST_SCHEMA_PROPERTIES)
+    key = (tuple(drivers), feature_count, geometry_type, tuple(sorted(properties.items())))
+    if key in _benchmarks and not refresh:
+        return _benchmarks[key]
+
+    features = synthetic_features(feature_count, geometry_type, properties)
+    results = []
+    for driver in drivers:
+        result = {"driver": driver, "write_seconds": None, "read_seconds": None, "write_features_per_second": None,
+                  "read_features_per_second": None, "bytes": None, "error": None}
+        extension = fsd.file_extensions.get(driver)
+        with tempfile.TemporaryDirectory() as directory:
+            target = os.path.join(directory, f"benchmark.{extension}")
+            try:
+                if not extension:
+                    raise ValueError("No file extension known for this driver.")
+                start = time.perf_counter()
+                with fiona.open(target, "w", **_meta(driver, geometry_type, properties)) as fh:
+                    fh.writerecords(features)
+                result["write_seconds"] = time.perf_counter() - start
+                result["bytes"] = _directory_size(directory)
+
+                start = time.perf_counter()
+                with fiona.open(target, "r") as fh:
+                    read_back = [f if isinstance(f, dict) else f.__geo_interface__ for f in fh]
+                    read_properties = fh.schema["properties"]
+                result["read_seconds"] = time.perf_counter() - start
+                _check_round_trip(features, read_back, properties, read_properties)
+
+                result["write_features_per_second"] = feature_count / max(result["write_seconds"], 1e-9)
+                result["read_features_per_second"] = feature_count / max(result["read_seconds"], 1e-9)
+            except Exception as e:
+                result["error"] = f"{e}"
+        results.append(result)
+
+    results.sort(key=lambda r: (r["error"] is not None, r["write_seconds"] or 0))
+    _benchmarks[key] = results
+    return results
+
+
+def choose_fastest_driver(geometry_type="Point", feature_count=10000, need_append=False, properties=None):
+    """
+    Pick the driver that wrote (and read back) the benchmark data fastest. The benchmark uses your geometry type and
+    properties, so drivers that can't store them never win.
+
+    :param geometry_type: geometry type of the data you want to write
+    :param feature_count: size of the benchmark
+    :param need_append: only consider drivers that can append (stream)
+    :param properties: dict of property name to Fiona type, i.e. your schema["properties"].
+    :return: driver name
+    """
+    capabilities = probe_driver_capabilities(verify=need_append)
+    for result in benchmark_drivers(feature_count=feature_count, geometry_type=geometry_type,
+                                    properties=properties):
+        if result["error"]:
+            continue
+        if need_append and not capabilities[result["driver"]]["stream"]:
+            continue
+        return result["driver"]
+    raise ValueError(f"No driver on this machine could write {geometry_type} data.")
+
+
+if __name__ == "__main__":
+    for name, capability in probe_driver_capabilities().items():
+        print(f"{name:20} {capability}")
+    for row in benchmark_drivers():
+        print(row)
+    print(f"Fastest: {choose_fastest_driver()}")
@@ -2,6 +2,9 @@
 OrderedDict is just a dictionary that preserves the order in which the keys were created. You can use any of the
 standard dictionary methods in the usual way.
 
+This only says which extension to use for a driver (and, below, which schema type names Fiona wants). To find out what
+a driver can actually do on your machine, see driver_capabilities.py.
+
 MF
 March 2019
 """
@@ -17,6 +20,8 @@ file_extensions = OrderedDict({
     'OpenFileGDB': None,
     'ESRI Shapefile': 'shp',
     'GeoJSON': 'json',
+    'GeoJSONSeq': 'geojsonl',
+    'FlatGeobuf': 'fgb',
     'GPKG': 'gpkg',
     'GML': 'gml',
     'GPX': 'gpx',
@@ -26,5 +31,23 @@ file_extensions = OrderedDict({
     'DGN': None,
     'S57': None,
     'SEGY': None,
+    'SQLite': 'sqlite',
     'SUA': None
 })
+
+# Type names that turn up in schemas (OWSlib gives us XML Schema names) but that Fiona doesn't accept.
+FIONA_TYPES = {"string": "str", "double": "float", "decimal": "float"}
+
+
+def fiona_property_types(properties):
+    """
+    Translate schema property types into ones Fiona accepts, keeping any width, e.g. "double:24.15" -> "float:24.15".
+
+    :param properties: dict of property name to type, i.e. schema["properties"]
+    :return: new dict
+    """
+    translated = {}
+    for name, kind in properties.items():
+        base, separator, width = kind.partition(":")
+        translated[name] = FIONA_TYPES.get(base, base) + separator + width
+    return translated
@@ -0,0 +1,349 @@
+"""
+An offline gazetteer built from a point layer such as TUDublin:geonames_ie.
+
+Nominatim is great but every lookup is a trip across the Internet. If we've already downloaded a place-name layer with
+'download_wfs_data' we can answer most questions locally:
+* forward lookups use an index of normalised names, with a trigram index to catch near misses.
+* reverse lookups use a KD-tree over the place coordinates to find the nearest place.
+
+Responses have the same {"body": {...}} shape as 'geocode_address' and 'geocode_location' in geopy_nominatim.py, and
+both of those accept a 'gazetteer' so that it's tried first and Nominatim is only called when it has no answer.
+"""
+
+# If any of these imports fail, it's likely to be because you haven't installed the appropriate library.
+try:
+    import datetime
+    import math
+    import re
+    import unicodedata
+    import pyproj
+    from shapely.geometry import Point
+except Exception as e:
+    print(f"{e}")
+    quit(1)
+
+# Mean radius of the Earth in metres, good enough for nearest-place distances.
+EARTH_RADIUS = 6371008.8
+
+# Where to find names in a geonames layer. 'alternatenames' is a comma-separated list.
+NAME_FIELDS = ("name", "asciiname", "alternatenames")
+
+# Default trigram similarity for a fuzzy match. High enough that a town name with "Road" or "St" on the end doesn't
+# pass, e.g. 'drumcondra road' scores 0.69 against 'drumcondra'.
+MIN_SIMILARITY = 0.75
+
+# Words that mark a query as a street address. We don't fuzzy match these as the nearest-named town would be wrong.
+STREET_WORDS = {"road", "rd", "street", "st", "avenue", "ave", "lane", "ln", "drive", "dr", "terrace", "tce", "place",
+                "square", "sq", "park", "court", "ct", "crescent", "cres", "close", "grove", "gardens", "gdns", "way",
+                "row", "quay", "hill", "walk", "view", "green", "upper", "lower", "north", "south", "apartment", "apt",
+                "unit", "house"}
+
+
+def normalise_name(name):
+    """
+    Reduce a place name to lower-case ASCII words separated by single spaces, so that 'Baile Átha Cliath' and
+    'baile atha-cliath' match.
+
+    :param name: place name
+    :return: normalised name
+    """
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return re.sub(r"[^a-z0-9]+", " ", stripped.lower()).strip()
+
+
+def trigrams(normalised):
+    """
+    The set of character trigrams of a normalised name, padded so that short names still have some.
+
+    :param normalised: output of 'normalise_name'
+    :return: set of strings
+    """
+    padded = f"  {normalised} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _to_unit_vector(lon, lat):
+    # Points on a unit sphere. Straight-line distance between these is in the same order as great-circle distance, so
+    # an ordinary KD-tree gives us the true nearest place.
+    lam, phi = math.radians(lon), math.radians(lat)
+    return math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi)
+
+
+def _build_kd_tree(items, depth=0):
+    # items are (vector, index). Nodes are (vector, index, axis, left, right).
+    if not items:
+        return None
+    axis = depth % 3
+    items.sort(key=lambda item: item[0][axis])
+    middle = len(items) // 2
+    vector, index = items[middle]
+    return (vector, index, axis,
+            _build_kd_tree(items[:middle], depth + 1),
+            _build_kd_tree(items[middle + 1:], depth + 1))
+
+
+def _nearest(node, target, best):
+    # best is [squared distance, index], updated in place. Search the side of the split that the target is on first
+    # so that we can usually skip the other side entirely.
+    vector, index, axis, left, right = node
+    distance = (vector[0] - target[0]) ** 2 + (vector[1] - target[1]) ** 2 + (vector[2] - target[2]) ** 2
+    if distance < best[0]:
+        best[0], best[1] = distance, index
+    difference = target[axis] - vector[axis]
+    near, far = (left, right) if difference < 0 else (right, left)
+    if near:
+        _nearest(near, target, best)
+    if far and difference * difference < best[0]:
+        _nearest(far, target, best)
+
+
+def parse_location(location):
+    """
+    Split a location into x and y. Accepts a Shapely Point or a string in 'x, y' format, the same as
+    'geocode_location'.
+
+    :param location: Point or str
+    :return: (x, y)
+    """
+    if isinstance(location, Point):
+        return location.x, location.y
+    if isinstance(location, str):
+        parts = location.strip().split(",")
+        return float(parts[0]), float(parts[1])
+    raise ValueError(f"Can't understand location '{location}'")
+
+
+class Gazetteer:
+    """
+    In-memory gazetteer over a list of GeoJSON point features.
+
+    :param features: GeoJSON features, e.g. result["geojson_data"]["features"] from 'download_wfs_data'.
+    :param epsg: EPSG code of the feature coordinates. Anything other than 4326 is converted on loading.
+    :param name_fields: properties that hold names for a place.
+    :param max_distance: reverse lookups further than this (in metres) from any place count as 'no result'.
+    :param min_similarity: trigram similarity (0 to 1) needed for a fuzzy forward match. Can be overridden per lookup.
+    The default, MIN_SIMILARITY, is deliberately strict so that near misses go to Nominatim.
+    """
+
+    def __init__(self, features, epsg=4326, name_fields=NAME_FIELDS, max_distance=5000,
+                 min_similarity=MIN_SIMILARITY):
+        self.max_distance = max_distance
+        self.min_similarity = min_similarity
+        self.places = []
+        self.names = {}
+        self.trigram_index = {}
+        self.name_trigrams = {}
+
+        points = [f for f in features if f.get("geometry") and f["geometry"]["type"] == "Point"]
+        xs = [f["geometry"]["coordinates"][0] for f in points]
+        ys = [f["geometry"]["coordinates"][1] for f in points]
+        if int(epsg) != 4326 and points:
+            # One call for the whole layer rather than one per point.
+            transformer = pyproj.Transformer.from_crs(int(epsg), 4326, always_xy=True)
+            xs, ys = transformer.transform(xs, ys)
+
+        for feature, lon, lat in zip(points, xs, ys):
+            properties = feature.get("properties") or {}
+            index = len(self.places)
+            self.places.append({"id": feature.get("id"), "lon": lon, "lat": lat, "properties": properties})
+
+            for field in name_fields:
+                value = properties.get(field)
+                if not value:
+                    continue
+                for name in (value.split(",") if field == "alternatenames" else [value]):
+                    normalised = normalise_name(name)
+                    if normalised:
+                        self.names.setdefault(normalised, set()).add(index)
+
+        for normalised in self.names:
+            grams = trigrams(normalised)
+            self.name_trigrams[normalised] = len(grams)
+            for gram in grams:
+                self.trigram_index.setdefault(gram, []).append(normalised)
+
+        self.tree = _build_kd_tree([(_to_unit_vector(p["lon"], p["lat"]), i) for i, p in enumerate(self.places)])
+
+    @classmethod
+    def from_wfs_result(cls, result, epsg=4326, **kwargs):
+        """
+        Build a gazetteer from the dictionary returned by 'download_wfs_data'.
+
+        :param result: dict with 'geojson_data'
+        :param epsg: EPSG code used for the download ('srs'), 4326 if you didn't set one.
+        :return: Gazetteer
+        """
+        return cls(result["geojson_data"]["features"], epsg=epsg, **kwargs)
+
+    def _population(self, index):
+        population = self.places[index]["properties"].get("population")
+        return population if isinstance(population, (int, float)) else 0
+
+    def _fuzzy(self, normalised, min_similarity):
+        # Count shared trigrams for every name that has at least one, then score with the Jaccard index.
+        query = trigrams(normalised)
+        shared = {}
+        for gram in query:
+            for name in self.trigram_index.get(gram, ()):
+                shared[name] = shared.get(name, 0) + 1
+        scored = []
+        for name, common in shared.items():
+            similarity = common / (len(query) + self.name_trigrams[name] - common)
+            if similarity >= min_similarity:
+                scored.append((similarity, name))
+        return sorted(scored, reverse=True)
+
+    def forward(self, query, limit=1, min_similarity=None, leading_part=True):
+        """
+        Find places by name. We answer for the whole query, exactly or fuzzily, or for an exact match on the leading
+        (most specific) part of a comma-separated query such as 'Drumcondra, Dublin, Ireland'. We never answer for a
+        later part and never fuzzy match a query with digits or street words (see STREET_WORDS) in it, so
+        '12 Main Street, Swords, Dublin' and 'Swords Road, Santry' find nothing rather than a town, and a street
+        address can go to Nominatim. Exact (normalised) matches beat fuzzy ones and bigger places beat smaller ones.
+
+        :param query: place name or address
+        :param limit: maximum number of results
+        :param min_similarity: trigram similarity (0 to 1) needed for a fuzzy match, defaults to the gazetteer's. Use 1
+        to only accept exact matches.
+        :param leading_part: also try an exact match on the leading part of a comma-separated query.
+        :return: list of (place dict, similarity, matched) tuples, best first. 'matched' is the normalised text that
+        matched.
+        """
+        min_similarity = self.min_similarity if min_similarity is None else min_similarity
+        whole = normalise_name(query)
+        parts = [whole]
+        if leading_part and "," in query:
+            parts.append(normalise_name(query.split(",")[0]))
+
+        for part in parts:
+            if part in self.names:
+                ranked = sorted(self.names[part], key=self._population, reverse=True)
+                return [(self.places[i], 1.0, part) for i in ranked[:limit]]
+
+        if not whole or any(word.isdigit() or word in STREET_WORDS for word in whole.split()):
+            return []
+        candidates = []
+        for similarity, name in self._fuzzy(whole, min_similarity):
+            candidates.extend((similarity, self._population(i), i) for i in self.names[name])
+        candidates.sort(reverse=True)
+        return [(self.places[i], similarity, whole) for similarity, _, i in candidates[:limit]]
+
+    def reverse(self, lon, lat):
+        """
+        Find the nearest place to a WGS84 coordinate.
+
+        :param lon: longitude
+        :param lat: latitude
+        :return: (place dict, distance in metres) or None if the gazetteer is empty
+        """
+        if not self.tree:
+            return None
+        best = [float("inf"), None]
+        _nearest(self.tree, _to_unit_vector(lon, lat), best)
+        chord = math.sqrt(best[0])
+        return self.places[best[1]], 2 * EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+    def _raw(self, place, **extra):
+        # Something that looks enough like a Nominatim 'raw' result that callers don't need to care where it came from.
+        properties = place["properties"]
+        raw = {
+            "place_id": properties.get("geonameid", place["id"]),
+            "lat": str(place["lat"]),
+            "lon": str(place["lon"]),
+            "display_name": properties.get("name") or properties.get("asciiname"),
+            "class": properties.get("featureclass"),
+            "type": properties.get("featurecode"),
+            "source": "gazetteer",
+            "properties": properties
+        }
+        raw.update(extra)
+        return raw
+
+    def geocode_address(self, address="", min_similarity=None, leading_part=True):
+        """
+        Same as 'geocode_address' in geopy_nominatim.py but answered from the gazetteer. See 'forward' for what counts
+        as a match.
+
+        :param address: Address to be geocoded
+        :param min_similarity: see 'forward'
+        :param leading_part: see 'forward'
+        :return: response as dict
+        """
+        body = {}
+
+        try:
+            if not address:
+                raise Exception("No address supplied")
+
+            found = self.forward(address, min_similarity=min_similarity, leading_part=leading_part)
+            if not found:
+                raise Exception(f"No result found for '{address}'")
+            place, similarity, matched = found[0]
+
+            body["message"] = f"Called 'geocode_address'. OK! {datetime.datetime.now()}"
+            body["input_address"] = address
+            body["result"] = self._raw(place, similarity=similarity, matched=matched)
+
+            response = {
+                "body": body
+            }
+        except Exception as e:
+            body["error"] = f"{e} - {datetime.datetime.now()}"
+            response = {
+                "body": body
+            }
+
+        return response
+
+    def geocode_location(self, location="", epsg=4326):
+        """
+        Same as 'geocode_location' in geopy_nominatim.py but answered from the gazetteer.
+
+        :param location: string in lon, lat or a Shapely Point
+        :param epsg: EPSG code of input coordinates, these will be converted to EPSG:4326 if not already 4326
+        :return: dict response
+        """
+        body = {}
+
+        try:
+            if not location:
+                raise Exception("No location supplied")
+
+            x, y = parse_location(location)
+            if int(epsg) != 4326:
+                input_transformer = pyproj.Transformer.from_crs(int(epsg), 4326, always_xy=True)
+                lon, lat = input_transformer.transform(x, y)
+            else:
+                lon, lat = x, y
+
+            found = self.reverse(lon, lat)
+            if not found or found[1] > self.max_distance:
+                raise Exception(f"No result found for '{location}'")
+            place, distance = found
+
+            body["message"] = f"Called 'geocode_location'. OK! {datetime.datetime.now()}"
+            body["input_location"] = location
+            body["result"] = self._raw(place, distance=distance)
+
+            response = {
+                "body": body
+            }
+        except Exception as e:
+            body["error"] = f"{e} - {datetime.datetime.now()}"
+            response = {
+                "body": body
+            }
+
+        return response
+
+
+if __name__ == "__main__":
+    # Build a gazetteer from geonames_ie and try a few lookups.
+    from utilities.download_from_geoserver import download_wfs_data
+
+    places = download_wfs_data(workspace="TUDublin", dataset="geonames_ie", filter_expression="featureclass = 'P'")
+    gazetteer = Gazetteer.from_wfs_result(places)
+    print(gazetteer.geocode_address("Drumcondra, Dublin, Ireland"))
+    print(gazetteer.geocode_location("-6.33, 53.33"))
+    print(gazetteer.geocode_location("200000.0, 250000", 29902))
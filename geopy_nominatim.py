@@ -10,16 +10,25 @@ except Exception as e:
 
 geolocator = Nominatim(user_agent="gisp-agent")
 
-def geocode_address(address=""):
+def geocode_address(address="", gazetteer=None, min_similarity=None):
     """
     Address geocoder using OSM Nominatim. Accepts 'address' string and returns a dictionary response containing
     everything that the geocoder provides.
 
     :param address: Address to be geocoded
+    :param gazetteer: Optional local 'Gazetteer' (see gazetteer.py). It's asked first and Nominatim is only called if it
+    has no answer. It only answers if the whole address, or its first comma-separated part, names a place it knows.
+    :param min_similarity: how close (0 to 1) a gazetteer name must be to count as an answer, 1 for exact matches only.
+    Defaults to the gazetteer's own setting.
     :return: response as dict
     """
     body = {}
 
+    if gazetteer and address:
+        response = gazetteer.geocode_address(address, min_similarity=min_similarity)
+        if "error" not in response["body"]:
+            return response
+
     try:
         if not address:
             raise Exception("No address supplied")
@@ -47,17 +56,24 @@ def geocode_address(address=""):
     return response
 
 
-def geocode_location(location="", epsg=4326):
+def geocode_location(location="", epsg=4326, gazetteer=None):
     """
     Address geocoder using OSM Nominatim. Accepts 'location' string in lat, lon format and returns a
     dictionary response containing everything that the geocoder provides.
 
     :param location: string in lon, lat
     :param epsg: EPSG code of input coordinates, these will be converted to EPSG:4326 if not already 4326
+    :param gazetteer: Optional local 'Gazetteer' (see gazetteer.py). It's asked first and Nominatim is only called if
+    there's no place within its 'max_distance'.
     :return: dict response
     """
     body = {}
 
+    if gazetteer and location:
+        response = gazetteer.geocode_location(location, epsg)
+        if "error" not in response["body"]:
+            return response
+
     try:
         if not location:
             raise Exception("No location supplied")
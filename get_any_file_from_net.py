@@ -1,17 +1,51 @@
-from io import BytesIO
+import codecs
+import tempfile
 from zipfile import ZipFile
 import requests
 import os
 from utilities.get_or_create_temporary_directory import get_temporary_directory as get_temp
 
+# Bytes read from the network at a time. Memory use depends on this, not on the size of the file.
+DEFAULT_CHUNK_SIZE = 64 * 1024
 
-def get_file_from_server(url, return_directory, **kwargs):
+
+def _stream_to_file(response, fh, chunk_size, progress, decoder=None):
+    # Copy the body to 'fh' a chunk at a time, decoding if we've been given a decoder. Progress is in bytes off the
+    # wire, the same as Content-Length. With gzip (which requests asks for) the chunks we get are bigger than that, so
+    # if we can't count wire bytes we don't give a total.
+    total = int(response.headers["Content-Length"]) if response.headers.get("Content-Length") else None
+    wire_bytes = getattr(response.raw, "tell", None)
+    if not wire_bytes and response.headers.get("Content-Encoding", "identity") != "identity":
+        total = None
+    done = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if not chunk:
+            continue
+        fh.write(decoder.decode(chunk) if decoder else chunk)
+        done = wire_bytes() if wire_bytes else done + len(chunk)
+        if progress:
+            progress(done, total)
+    if decoder:
+        fh.write(decoder.decode(b"", final=True))
+    return done
+
+
+def get_file_from_server(url, return_directory, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, encoding=None,
+                         **kwargs):
     """
-    This accepts a  a URL and (ii) retrieves a zipped shapefile from the URL.
+    This accepts a URL and retrieves a zipped shapefile, CSV or JSON file from it. The response is streamed to disk a
+    chunk at a time so large files don't have to fit in memory.
 
-    :param return_directory:
-    :param url: URL of zip file
-    :return: a list of files from th zip file
+    :param url: URL of the file
+    :param return_directory: where to put the file (or the contents of the zip file)
+    :param chunk_size: bytes to read at a time
+    :param progress: optional function called as progress(bytes_so_far, total_bytes) after each chunk. Both count bytes
+    as sent by the server (before any gzip is undone). total_bytes is None if we don't know it.
+    :param encoding: for CSV/JSON, the encoding to write the file in. None (the default) writes the bytes exactly as
+    received, which is safe for any content. Otherwise the body is decoded with the charset the server gave us
+    (utf-8 if none) and re-encoded.
+    :param kwargs: 'filename' to use instead of the one the server suggests
+    :return: a tuple of return_directory and a list of files from the zip file, or the file name
     """
 
     valid_formats = {
@@ -21,34 +55,48 @@ def get_file_from_server(url, return_directory, **kwargs):
     }
 
     try:
-        response = requests.get(url)
-        if 200 <= response.status_code <= 299:
-            if not response.headers["Content-Type"]:
+        with requests.get(url, stream=True) as response:
+            if not 200 <= response.status_code <= 299:
+                raise ValueError(f"Bad status code: {response.status_code}")
+            if not response.headers.get("Content-Type"):
                 raise ValueError("Couldn't figure out what type this is, sorry.")
             content_type = [item.strip().split("=") for item in
                             response.headers["Content-Type"].split(";")]
             if content_type[0][0] not in valid_formats.values():
                 raise ValueError(f"Looks like an invalid content type: {response.headers['Content-Type']}")
             if content_type[0][0] == "application/zip":
-                my_zipfile = ZipFile(BytesIO(response.content))
-                my_zipfile.extractall(path=return_directory)
-                return return_directory, my_zipfile.namelist()
+                # Spool the zip file to disk rather than memory, then unpack it.
+                with tempfile.TemporaryFile() as fh:
+                    _stream_to_file(response, fh, chunk_size, progress)
+                    fh.seek(0)
+                    my_zipfile = ZipFile(fh)
+                    my_zipfile.extractall(path=return_directory)
+                    return return_directory, my_zipfile.namelist()
             else:
                 content_disposition = [item.strip().split("=") for item in
-                                       response.headers["Content-Disposition"].split(";")]
+                                       response.headers.get("Content-Disposition", "").split(";")]
+                parameters = {}
                 for item in content_type + content_disposition:
                     if len(item) == 2:
-                        locals()[item[0]] = item[1]
+                        parameters[item[0].lower()] = item[1].strip('"')
+                if parameters.get("filename") and "filename" not in kwargs:
+                    # The server's filename must not take us out of return_directory, e.g. '../../x' or '/etc/x'.
+                    parameters["filename"] = os.path.basename(parameters["filename"].replace("\\", "/"))
+                    if parameters["filename"] in ("", ".", ".."):
+                        raise ValueError("The server's filename for the data isn't usable.")
                 if "filename" in kwargs:
-                    locals()["filename"] = kwargs["filename"]
-                if not locals()["filename"]:
+                    parameters["filename"] = kwargs["filename"]
+                if not parameters.get("filename"):
                     raise ValueError("Got data but couldn't find a filename for it.")
-                with open(os.path.join(return_directory, locals()["filename"]),
-                          mode="w", encoding=locals().get("charset", "utf-8")) as fh:
-                    fh.write(response.text)
-                    return return_directory, locals()["filename"]
-        else:
-            raise ValueError(f"Bad status code: {response.status_code}")
+                target = os.path.join(return_directory, parameters["filename"])
+                if encoding:
+                    decoder = codecs.getincrementaldecoder(parameters.get("charset", "utf-8"))(errors="replace")
+                    with open(target, mode="w", encoding=encoding, newline="") as fh:
+                        _stream_to_file(response, fh, chunk_size, progress, decoder)
+                else:
+                    with open(target, mode="wb") as fh:
+                        _stream_to_file(response, fh, chunk_size, progress)
+                return return_directory, parameters["filename"]
     except Exception as e:
         print(f"{e}")
         quit(1)
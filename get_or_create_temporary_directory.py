@@ -1,17 +1,310 @@
-import os
+"""
+A cache directory that can be shared by several processes on one host.
+
+'get_temporary_directory' just makes sure a '.cache' folder exists next to the calling program. 'CacheManager' builds on
+that for programs that run many workers at once:
+* entries live in namespaced subdirectories, e.g. 'datasets' or 'downloads'.
+* entries are written to a temporary file and renamed into place, so nobody ever reads half a file.
+* a lock file serialises changes between processes.
+* an optional byte quota is enforced by evicting the least recently used entries.
+* temporary files left behind by workers that died mid-write are removed once they're TEMP_GRACE_SECONDS old.
+* hit/miss/eviction counts are kept in the cache itself so they cover every process that uses it.
+"""
+
+try:
+    import json
+    import os
+    import threading
+    import time
+    from contextlib import contextmanager
+except Exception as e:
+    print(f"{e}")
+    quit(1)
+
+try:
+    import fcntl
+except ImportError:
+    # MS Windows doesn't have fcntl so we fall back to msvcrt.
+    fcntl = None
+    import msvcrt
+
+LOCK_FILE = ".lock"
+STATS_FILE = ".stats.json"
+TEMP_SUFFIX = ".tmp"
+
+# A temporary file that hasn't been written to for this long (in seconds) belongs to a worker that died mid-write.
+TEMP_GRACE_SECONDS = 3600
+
 
 def get_temporary_directory(file_of_calling_program, dir_name=".cache"):
     """
-    Make sure that the temp directory, '.temp_data' exists and if not is created. This is created in the path of the
+    Make sure that the temp directory, '.cache' exists and if not is created. This is created in the path of the
     calling program.
 
     :param file_of_calling_program: Use __file__ when calling
+    :param dir_name: name of the directory, defaults to '.cache'
     :return: the temporary directory
     """
 
     script_dir = os.path.dirname(file_of_calling_program)
     cache_dir = os.path.join(script_dir, dir_name)
-    if not os.path.exists(cache_dir):
-        os.mkdir(cache_dir)
+    # Several processes may get here at the same time so don't fail if someone else has just created it.
+    os.makedirs(cache_dir, exist_ok=True)
 
     return cache_dir
+
+
+def get_cache_manager(file_of_calling_program, dir_name=".cache", quota_bytes=None):
+    """
+    Same as 'get_temporary_directory' but returns a 'CacheManager' for the directory.
+
+    :param file_of_calling_program: Use __file__ when calling
+    :param dir_name: name of the directory, defaults to '.cache'
+    :param quota_bytes: maximum size of the cache in bytes, None for no limit.
+    :return: CacheManager
+    """
+    return CacheManager(get_temporary_directory(file_of_calling_program, dir_name), quota_bytes=quota_bytes)
+
+
+def _check_name(name):
+    if not name or name.startswith(".") or os.sep in name or (os.altsep and os.altsep in name):
+        raise ValueError(f"Invalid cache name: '{name}'")
+    if name.endswith(TEMP_SUFFIX):
+        raise ValueError(f"Cache names can't end in '{TEMP_SUFFIX}'")
+    return name
+
+
+class CacheManager:
+    """
+    Manage a cache directory shared between processes. Each entry is a single file identified by a namespace and a
+    key (the file name).
+
+    :param root: the cache directory, created if necessary.
+    :param quota_bytes: maximum total size of all entries in bytes, None for no limit.
+    :param temp_grace_seconds: how old an abandoned temporary file must be before it's removed.
+    """
+
+    def __init__(self, root, quota_bytes=None, temp_grace_seconds=TEMP_GRACE_SECONDS):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.temp_grace_seconds = temp_grace_seconds
+        os.makedirs(self.root, exist_ok=True)
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the cross-process lock for the whole cache. Use as a context manager.
+        """
+        with open(os.path.join(self.root, LOCK_FILE), "a+b") as fh:
+            if fcntl:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            else:
+                fh.seek(0)
+                # msvcrt.LK_LOCK gives up after 10 seconds, so keep trying.
+                while True:
+                    try:
+                        msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                else:
+                    fh.seek(0)
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def namespace(self, namespace):
+        """
+        Make sure a namespace directory exists.
+
+        :param namespace: name of the namespace, e.g. 'datasets'
+        :return: the namespace directory
+        """
+        directory = os.path.join(self.root, _check_name(namespace))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def path(self, namespace, key):
+        """
+        Where the entry for 'key' lives, whether or not it exists yet.
+
+        :param namespace: name of the namespace
+        :param key: entry name
+        :return: file path
+        """
+        return os.path.join(self.namespace(namespace), _check_name(key))
+
+    def get(self, namespace, key):
+        """
+        Look up an entry and count a hit or a miss. A hit marks the entry as recently used.
+
+        :param namespace: name of the namespace
+        :param key: entry name
+        :return: file path of the entry, or None if it isn't cached
+        """
+        target = self.path(namespace, key)
+        with self.lock():
+            try:
+                # We keep the last-used time in the modification time; access times are often switched off.
+                os.utime(target)
+                found = True
+            except FileNotFoundError:
+                found = False
+            self._count("hits" if found else "misses")
+
+        return target if found else None
+
+    def put(self, namespace, key, data=None, writer=None):
+        """
+        Add or replace an entry. Supply either 'data' or 'writer'. The entry is written to a temporary file and then
+        renamed into place, after which the cache is trimmed to its quota.
+
+        :param namespace: name of the namespace
+        :param key: entry name
+        :param data: bytes to store
+        :param writer: function that accepts a file path and writes the entry to it, for large entries.
+        :return: file path of the entry
+        """
+        if (data is None) == (writer is None):
+            raise ValueError("Supply one of 'data' or 'writer'.")
+
+        target = self.path(namespace, key)
+        temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}"
+        try:
+            if writer:
+                writer(temp_path)
+            else:
+                with open(temp_path, "wb") as fh:
+                    fh.write(data)
+            with self.lock():
+                os.replace(temp_path, target)
+                self._evict(keep=target)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        return target
+
+    def remove(self, namespace, key):
+        """
+        Remove an entry if it exists.
+
+        :param namespace: name of the namespace
+        :param key: entry name
+        """
+        with self.lock():
+            try:
+                os.remove(self.path(namespace, key))
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        """
+        All entries in the cache, least recently used first.
+
+        :return: list of (path, size, last used time) tuples
+        """
+        found = []
+        for namespace in os.listdir(self.root):
+            directory = os.path.join(self.root, namespace)
+            if namespace.startswith(".") or not os.path.isdir(directory):
+                continue
+            for key in os.listdir(directory):
+                if key.startswith(".") or key.endswith(TEMP_SUFFIX):
+                    continue
+                try:
+                    info = os.stat(os.path.join(directory, key))
+                except FileNotFoundError:
+                    continue
+                found.append((os.path.join(directory, key), info.st_size, info.st_mtime))
+        found.sort(key=lambda entry: entry[2])
+        return found
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is within its quota, and any abandoned temporary files.
+
+        :return: number of entries removed
+        """
+        with self.lock():
+            return self._evict()
+
+    def stats(self):
+        """
+        Hit, miss and eviction counts for every process that has used this cache, plus its current size.
+
+        :return: dict
+        """
+        with self.lock():
+            stats = self._read_stats()
+            entries = self.entries()
+        stats["entries"] = len(entries)
+        stats["bytes"] = sum(size for _, size, _ in entries)
+        stats["quota_bytes"] = self.quota_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else None
+        return stats
+
+    def _remove_stale_temp_files(self):
+        # Caller must hold the lock. Files still being written are newer than the grace period so are left alone.
+        cutoff = time.time() - self.temp_grace_seconds
+        directories = [self.root] + [os.path.join(self.root, n) for n in os.listdir(self.root) if not n.startswith(".")]
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if not name.endswith(TEMP_SUFFIX):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                except (FileNotFoundError, PermissionError):
+                    pass
+
+    def _evict(self, keep=None):
+        # Caller must hold the lock.
+        self._remove_stale_temp_files()
+        if self.quota_bytes is None:
+            return 0
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for path, size, _ in entries:
+            if total <= self.quota_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # On MS Windows a file that another process has open can't be removed. Leave it for next time.
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            self._count("evictions", removed)
+        return removed
+
+    def _read_stats(self):
+        stats = {"hits": 0, "misses": 0, "evictions": 0}
+        try:
+            with open(os.path.join(self.root, STATS_FILE), "r") as fh:
+                stats.update(json.load(fh))
+        except (FileNotFoundError, ValueError):
+            pass
+        return stats
+
+    def _count(self, counter, amount=1):
+        # Caller must hold the lock.
+        stats = self._read_stats()
+        stats[counter] += amount
+        temp_path = os.path.join(self.root, f"{STATS_FILE}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}")
+        with open(temp_path, "w") as fh:
+            json.dump(stats, fh)
+        os.replace(temp_path, os.path.join(self.root, STATS_FILE))
@@ -0,0 +1,568 @@
+"""
+Binary on-disk cache of parsed Geoserver datasets.
+
+Parsing a large GeoJSON response (and asking Geoserver for the schema) every time we run a program is slow. This module
+saves the result of 'download_wfs_data' in a compact binary file and loads it again through a memory map.
+
+* Geometries are stored as (little-endian, ISO) WKB.
+* Properties are stored column by column - int64, float64, bool or UTF-8 text - each with a null mask.
+* The normalised schema and everything else in the FeatureCollection is kept in a small JSON header.
+
+Most of the cost of loading is building a Python dict for every feature. If you don't need them all at once, read with
+lazy=True: features are then decoded one at a time as you use them, and whole property columns can be had without
+building any features at all.
+
+Cache entries are keyed on host, workspace, dataset, filter, property list and SRS, so a different query never picks up
+the wrong file. To use, pass 'cache_directory' (a directory or a 'CacheManager') to 'download_wfs_data' or call the
+functions here directly.
+"""
+
+try:
+    import gc
+    import hashlib
+    import json
+    import mmap
+    import os
+    import struct
+    import sys
+    import threading
+    from array import array
+    from collections.abc import Sequence
+except Exception as e:
+    print(f"{e}")
+    quit(1)
+
+MAGIC = b"SSPLPDS1"
+FILE_EXTENSION = "pds"
+
+# Namespace used when the cache is kept in a 'CacheManager'.
+CACHE_NAMESPACE = "datasets"
+
+# Schema types (after 'download_wfs_data' has tidied them up) and how we store them.
+INT_TYPES = ("int", "integer", "long", "short", "byte")
+FLOAT_TYPES = ("float", "double", "decimal")
+BOOL_TYPES = ("bool", "boolean")
+
+# WKB geometry type codes.
+WKB_TYPES = {
+    "Point": 1,
+    "LineString": 2,
+    "Polygon": 3,
+    "MultiPoint": 4,
+    "MultiLineString": 5,
+    "MultiPolygon": 6,
+    "GeometryCollection": 7
+}
+GEOJSON_TYPES = {v: k for k, v in WKB_TYPES.items()}
+
+
+def dataset_cache_key(host=None, workspace=None, dataset=None, filter_expression=None, property_list=None, srs=None):
+    """
+    Make a key that identifies a dataset query. Two calls to 'download_wfs_data' that would return the same data
+    return the same key.
+
+    :param host: Geoserver host.
+    :param workspace: WS on Geoserver.
+    :param dataset: WFS dataset name.
+    :param filter_expression: ECQL or CQL expression, if any.
+    :param property_list: list or comma-separated string of properties, if any.
+    :param srs: EPSG code, if any.
+    :return: hex string
+    """
+    if isinstance(property_list, str):
+        property_list = property_list.split(",")
+    properties = sorted(p.strip() for p in property_list) if property_list else []
+    identity = [host, workspace, dataset, filter_expression or "", properties, str(srs) if srs else ""]
+
+    return hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()
+
+
+def cached_dataset_path(cache_directory, key):
+    """
+    Where the cache entry for 'key' lives.
+
+    :param cache_directory: directory holding cache entries.
+    :param key: from 'dataset_cache_key'.
+    :return: file path
+    """
+    return os.path.join(cache_directory, f"{key}.{FILE_EXTENSION}")
+
+
+def _coordinate_dims(coordinates):
+    # Dig down to the first position to see if we have 2D or 3D data.
+    while isinstance(coordinates, (list, tuple)) and coordinates and isinstance(coordinates[0], (list, tuple)):
+        coordinates = coordinates[0]
+    return 3 if len(coordinates or []) > 2 else 2
+
+
+def _pack_positions(positions, dims):
+    flat = []
+    for position in positions:
+        flat.extend(position[:dims])
+        if len(position) < dims:
+            flat.extend([0.0] * (dims - len(position)))
+    return struct.pack(f"<I{len(flat)}d", len(positions), *flat)
+
+
+def geometry_to_wkb(geometry):
+    """
+    Convert a GeoJSON geometry dictionary to WKB. Only the standard library is used so that we don't pay for building
+    Shapely objects just to throw them away.
+
+    :param geometry: GeoJSON geometry as dict (or None)
+    :return: bytes (empty for a null geometry)
+    """
+    if not geometry:
+        return b""
+
+    geometry_type = geometry["type"]
+    if geometry_type == "GeometryCollection":
+        members = [geometry_to_wkb(g) for g in geometry["geometries"]]
+        return struct.pack("<BII", 1, WKB_TYPES[geometry_type], len(members)) + b"".join(members)
+
+    coordinates = geometry["coordinates"]
+    dims = _coordinate_dims(coordinates)
+    code = WKB_TYPES[geometry_type] + (1000 if dims == 3 else 0)
+    header = struct.pack("<BI", 1, code)
+
+    if geometry_type == "Point":
+        if not coordinates:
+            return header + struct.pack(f"<{dims}d", *([float("nan")] * dims))
+        return header + struct.pack(f"<{dims}d", *(list(coordinates[:dims]) + [0.0] * (dims - len(coordinates))))
+    if geometry_type == "LineString":
+        return header + _pack_positions(coordinates, dims)
+    if geometry_type == "Polygon":
+        return header + struct.pack("<I", len(coordinates)) + b"".join(_pack_positions(r, dims) for r in coordinates)
+
+    # Multi-geometries are a count followed by complete WKB members.
+    member_type = geometry_type[5:]
+    members = [geometry_to_wkb({"type": member_type, "coordinates": c}) for c in coordinates]
+    return header + struct.pack("<I", len(members)) + b"".join(members)
+
+
+def _unpack_positions(buffer, offset, dims):
+    (count,) = struct.unpack_from("<I", buffer, offset)
+    offset += 4
+    values = struct.unpack_from(f"<{count * dims}d", buffer, offset)
+    if dims == 2:
+        positions = list(map(list, zip(values[0::2], values[1::2])))
+    else:
+        positions = list(map(list, zip(values[0::3], values[1::3], values[2::3])))
+    return positions, offset + 8 * count * dims
+
+
+def _read_wkb(buffer, offset):
+    byte_order, code = struct.unpack_from("<BI", buffer, offset)
+    if byte_order != 1:
+        raise ValueError("Only little-endian WKB is supported.")
+    offset += 5
+    dims = 3 if code > 1000 else 2
+    geometry_type = GEOJSON_TYPES[code % 1000]
+
+    if geometry_type == "Point":
+        values = struct.unpack_from(f"<{dims}d", buffer, offset)
+        coordinates = [] if values[0] != values[0] else list(values)
+        return {"type": geometry_type, "coordinates": coordinates}, offset + 8 * dims
+    if geometry_type == "LineString":
+        coordinates, offset = _unpack_positions(buffer, offset, dims)
+        return {"type": geometry_type, "coordinates": coordinates}, offset
+    if geometry_type == "Polygon":
+        (count,) = struct.unpack_from("<I", buffer, offset)
+        offset += 4
+        rings = []
+        for _ in range(count):
+            ring, offset = _unpack_positions(buffer, offset, dims)
+            rings.append(ring)
+        return {"type": geometry_type, "coordinates": rings}, offset
+
+    (count,) = struct.unpack_from("<I", buffer, offset)
+    offset += 4
+    members = []
+    for _ in range(count):
+        member, offset = _read_wkb(buffer, offset)
+        members.append(member)
+    if geometry_type == "GeometryCollection":
+        return {"type": geometry_type, "geometries": members}, offset
+    return {"type": geometry_type, "coordinates": [m["coordinates"] for m in members]}, offset
+
+
+def wkb_to_geometry(buffer):
+    """
+    Convert WKB (as written by 'geometry_to_wkb') back to a GeoJSON geometry dictionary.
+
+    :param buffer: bytes, memoryview or mmap slice
+    :return: dict or None for an empty buffer
+    """
+    if not len(buffer):
+        return None
+    geometry, _ = _read_wkb(buffer, 0)
+    return geometry
+
+
+def _column_encoding(schema_type, values):
+    # Use the schema type if every value agrees with it, otherwise fall back to JSON text so nothing is lost.
+    present = [v for v in values if v is not None]
+    if schema_type in BOOL_TYPES and all(isinstance(v, bool) for v in present):
+        return "bool"
+    if schema_type in INT_TYPES and all(isinstance(v, int) and not isinstance(v, bool) and -2 ** 63 <= v < 2 ** 63
+                                        for v in present):
+        return "int64"
+    if schema_type in FLOAT_TYPES and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return "float64"
+    if all(isinstance(v, str) for v in present):
+        return "text"
+    return "json"
+
+
+def _offsets_block(chunks):
+    offsets = array("q", [0])
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        offsets.append(total)
+    return offsets.tobytes() + b"".join(chunks)
+
+
+def _encode_column(encoding, values):
+    nulls = bytes(1 if v is None else 0 for v in values)
+    if encoding == "int64":
+        data = array("q", [0 if v is None else v for v in values]).tobytes()
+    elif encoding == "float64":
+        data = array("d", [0.0 if v is None else float(v) for v in values]).tobytes()
+    elif encoding == "bool":
+        data = bytes(1 if v else 0 for v in values)
+    elif encoding == "text":
+        data = _offsets_block([b"" if v is None else v.encode("utf-8") for v in values])
+    else:
+        data = _offsets_block([b"" if v is None else json.dumps(v).encode("utf-8") for v in values])
+    return nulls, data
+
+
+def write_parsed_dataset(path, result):
+    """
+    Save the dictionary returned by 'download_wfs_data' (JSON output) as a binary cache file. The file is written to a
+    temporary name and renamed into place so a reader never sees half a file.
+
+    :param path: target file, see 'cached_dataset_path'.
+    :param result: dict with 'schema' and 'geojson_data'.
+    :return: path
+    """
+    schema = result["schema"]
+    collection = result["geojson_data"]
+    features = collection.get("features", [])
+
+    # Columns come from the schema first and then anything else that turns up in the features.
+    columns = list(schema.get("properties", {}))
+    seen = set(columns)
+    for feature in features:
+        for name in (feature.get("properties") or {}):
+            if name not in seen:
+                seen.add(name)
+                columns.append(name)
+
+    blocks = []
+    blocks.append(("ids", _offsets_block([str(f.get("id", "")).encode("utf-8") for f in features])))
+    blocks.append(("has_id", bytes(1 if "id" in f else 0 for f in features)))
+    blocks.append(("geometry", _offsets_block([geometry_to_wkb(f.get("geometry")) for f in features])))
+
+    column_headers = []
+    for name in columns:
+        values = [(f.get("properties") or {}).get(name) for f in features]
+        encoding = _column_encoding(schema.get("properties", {}).get(name), values)
+        nulls, data = _encode_column(encoding, values)
+        column_headers.append({"name": name, "encoding": encoding})
+        blocks.append((f"nulls:{name}", nulls))
+        blocks.append((f"data:{name}", data))
+
+    # Anything that isn't a feature ('crs', 'bbox', 'totalFeatures' etc.) goes into the header as-is.
+    extra = {k: v for k, v in collection.items() if k != "features"}
+    extra_features = [{k: v for k, v in f.items() if k not in ("id", "geometry", "properties", "type")}
+                      for f in features]
+
+    layout = {}
+    position = 0
+    for name, data in blocks:
+        layout[name] = [position, len(data)]
+        position += len(data) + (-len(data) % 8)
+
+    header = json.dumps({
+        "byteorder": sys.byteorder,
+        "count": len(features),
+        "schema": schema,
+        "collection": extra,
+        "feature_extras": extra_features if any(extra_features) else None,
+        "columns": column_headers,
+        "blocks": layout
+    }).encode("utf-8")
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<Q", len(header)))
+        fh.write(header)
+        for _, data in blocks:
+            fh.write(data)
+            fh.write(b"\0" * (-len(data) % 8))
+    os.replace(temp_path, path)
+
+    return path
+
+
+def _read_offsets(buffer, start, count):
+    offsets = array("q")
+    offsets.frombytes(buffer[start:start + 8 * (count + 1)])
+    return offsets, start + 8 * (count + 1)
+
+
+def _open_mapped(path):
+    # Map the file and read its header. Returns the map, the header and where the blocks start.
+    with open(path, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{path}' isn't a parsed dataset cache file.")
+        (header_length,) = struct.unpack_from("<Q", mm, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(mm[start:start + header_length].decode("utf-8"))
+        # Columns are written in native byte order, which is little-endian on anything we're likely to meet.
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(f"'{path}' was written on a machine with a different byte order.")
+    except Exception:
+        mm.close()
+        raise
+    return mm, header, start + header_length
+
+
+def _block(header, data_start, name):
+    offset, length = header["blocks"][name]
+    return data_start + offset, data_start + offset + length
+
+
+def _decode_column(mm, header, data_start, column):
+    # Every value in a column, nulls and all.
+    count = header["count"]
+    name, encoding = column["name"], column["encoding"]
+    nulls = mm[slice(*_block(header, data_start, f"nulls:{name}"))]
+    data_from, data_to = _block(header, data_start, f"data:{name}")
+    if encoding in ("int64", "float64"):
+        values = array("q" if encoding == "int64" else "d")
+        values.frombytes(mm[data_from:data_to])
+        values = values.tolist()
+    elif encoding == "bool":
+        values = [b == 1 for b in mm[data_from:data_to]]
+    else:
+        offsets, payload_start = _read_offsets(mm, data_from, count)
+        raw = mm[payload_start:data_to]
+        values = [raw[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(count)]
+        if encoding == "json":
+            values = [json.loads(v) if v else None for v in values]
+    if any(nulls):
+        values = [None if nulls[i] else v for i, v in enumerate(values)]
+    return values
+
+
+def _read_points(mm, geometry_data, geometry_offsets, count):
+    # A layer of nothing but 2D points is a run of identical 21 byte WKB records, which we can unpack in one go. Returns
+    # None if the layer is anything else.
+    if not count or geometry_offsets != array("q", range(0, 21 * count + 1, 21)):
+        return None
+    records = mm[geometry_data:geometry_data + 21 * count]
+    if records[0::21] != b"\x01" * count or records[1::21] != b"\x01" * count \
+            or any(records[2::21] + records[3::21] + records[4::21]):
+        return None
+    return [{"type": "Point", "coordinates": [] if x != x else [x, y]}
+            for _, _, x, y in struct.iter_unpack("<BIdd", records)]
+
+
+class ParsedFeatures(Sequence):
+    """
+    The features of a parsed dataset file, decoded one at a time as you ask for them. Behaves like a (read-only) list
+    of GeoJSON features, so it can go anywhere that only iterates over or indexes the features. Use list() on it if
+    you need a real list, e.g. for json.dumps.
+
+    :param mm: memory map of the file, closed by 'close'.
+    :param header: the file's header.
+    :param data_start: where the blocks start in the map.
+    """
+
+    def __init__(self, mm, header, data_start):
+        self._mm = mm
+        self._header = header
+        self._data_start = data_start
+        self._count = header["count"]
+        self._extras = header.get("feature_extras")
+        self._columns = {}
+
+        self._id_offsets, self._ids_data = _read_offsets(mm, _block(header, data_start, "ids")[0], self._count)
+        self._has_id = mm[slice(*_block(header, data_start, "has_id"))]
+        self._geometry_offsets, self._geometry_data = \
+            _read_offsets(mm, _block(header, data_start, "geometry")[0], self._count)
+
+        # Where to find a single value of each column.
+        self._readers = []
+        for column in header["columns"]:
+            name, encoding = column["name"], column["encoding"]
+            nulls = mm[slice(*_block(header, data_start, f"nulls:{name}"))]
+            data_from, _ = _block(header, data_start, f"data:{name}")
+            offsets = payload_start = None
+            if encoding in ("text", "json"):
+                offsets, payload_start = _read_offsets(mm, data_from, self._count)
+            self._readers.append((name, encoding, nulls, data_from, offsets, payload_start))
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("feature index out of range")
+
+        mm = self._mm
+        feature = {"type": "Feature"}
+        if self._has_id[index]:
+            feature["id"] = mm[self._ids_data + self._id_offsets[index]:
+                               self._ids_data + self._id_offsets[index + 1]].decode("utf-8")
+        feature["geometry"] = self.geometry(index)
+        feature["properties"] = {reader[0]: self._value(reader, index) for reader in self._readers}
+        if self._extras:
+            feature.update(self._extras[index])
+        return feature
+
+    def _value(self, reader, index):
+        name, encoding, nulls, data_from, offsets, payload_start = reader
+        if name in self._columns:
+            return self._columns[name][index]
+        if nulls[index]:
+            return None
+        if encoding == "int64":
+            return struct.unpack_from("=q", self._mm, data_from + 8 * index)[0]
+        if encoding == "float64":
+            return struct.unpack_from("=d", self._mm, data_from + 8 * index)[0]
+        if encoding == "bool":
+            return self._mm[data_from + index] == 1
+        text = self._mm[payload_start + offsets[index]:payload_start + offsets[index + 1]].decode("utf-8")
+        if encoding == "json":
+            return json.loads(text) if text else None
+        return text
+
+    def geometry(self, index):
+        """
+        Decode just the geometry of one feature.
+
+        :param index: feature number
+        :return: GeoJSON geometry as dict, or None
+        """
+        if self._geometry_offsets[index] == self._geometry_offsets[index + 1]:
+            return None
+        geometry, _ = _read_wkb(self._mm, self._geometry_data + self._geometry_offsets[index])
+        return geometry
+
+    def column(self, name):
+        """
+        Every value of one property, in feature order, without building any features.
+
+        :param name: property name
+        :return: list
+        """
+        if name not in self._columns:
+            for column in self._header["columns"]:
+                if column["name"] == name:
+                    self._columns[name] = _decode_column(self._mm, self._header, self._data_start, column)
+                    break
+            else:
+                raise KeyError(name)
+        return self._columns[name]
+
+    def close(self):
+        """
+        Release the memory map. Features already decoded stay usable.
+        """
+        self._mm.close()
+
+
+def read_parsed_dataset(path, lazy=False):
+    """
+    Load a binary cache file written by 'write_parsed_dataset'. The file is memory mapped and geometries are decoded
+    straight out of the map, so only the pages we touch are read from disk.
+
+    :param path: cache file.
+    :param lazy: return the features as a 'ParsedFeatures', which decodes each feature when you use it, rather than
+    building them all up front. Much quicker if you only need some of the features or some of the columns.
+    :return: dict with 'schema' and 'geojson_data', the same as 'download_wfs_data' returns for JSON.
+    """
+    mm, header, data_start = _open_mapped(path)
+    if lazy:
+        features = ParsedFeatures(mm, header, data_start)
+    else:
+        with mm:
+            count = header["count"]
+            id_offsets, ids_data = _read_offsets(mm, _block(header, data_start, "ids")[0], count)
+            has_id = mm[slice(*_block(header, data_start, "has_id"))]
+            geometry_offsets, geometry_data = _read_offsets(mm, _block(header, data_start, "geometry")[0], count)
+            columns = [(column["name"], _decode_column(mm, header, data_start, column)) for column in header["columns"]]
+
+            # We create millions of small lists here and none of them can be part of a reference cycle, so the
+            # garbage collector would only slow us down.
+            feature_extras = header.get("feature_extras")
+            features = []
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                points = _read_points(mm, geometry_data, geometry_offsets, count)
+                for i in range(count):
+                    feature = {"type": "Feature"}
+                    if has_id[i]:
+                        feature["id"] = mm[ids_data + id_offsets[i]:ids_data + id_offsets[i + 1]].decode("utf-8")
+                    if points is not None:
+                        feature["geometry"] = points[i]
+                    elif geometry_offsets[i] == geometry_offsets[i + 1]:
+                        feature["geometry"] = None
+                    else:
+                        feature["geometry"], _ = _read_wkb(mm, geometry_data + geometry_offsets[i])
+                    feature["properties"] = {name: values[i] for name, values in columns}
+                    if feature_extras:
+                        feature.update(feature_extras[i])
+                    features.append(feature)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+
+    geojson_data = dict(header["collection"])
+    geojson_data["features"] = features
+
+    return {
+        "schema": header["schema"],
+        "geojson_data": geojson_data
+    }
+
+
+if __name__ == "__main__":
+    # Round-trip a small sample through the cache format.
+    import tempfile
+
+    sample = {
+        "schema": {"properties": {"name": "str", "population": "int", "area": "float"},
+                   "geometry": "MultiPolygon", "geometry_column": "geom"},
+        "geojson_data": {
+            "type": "FeatureCollection",
+            "features": [
+                {"type": "Feature", "id": "counties.1",
+                 "geometry": {"type": "MultiPolygon",
+                              "coordinates": [[[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 0.0]]]]},
+                 "properties": {"name": "Baile Átha Cliath", "population": 1273069, "area": 921.0}},
+                {"type": "Feature", "id": "counties.2", "geometry": None,
+                 "properties": {"name": None, "population": None, "area": 7.5}}
+            ]
+        }
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        cache_file = cached_dataset_path(directory, dataset_cache_key(workspace="census2011", dataset="counties"))
+        write_parsed_dataset(cache_file, sample)
+        print(read_parsed_dataset(cache_file) == sample)
+        lazy = read_parsed_dataset(cache_file, lazy=True)["geojson_data"]["features"]
+        print(list(lazy) == sample["geojson_data"]["features"], lazy.column("population"))
+        lazy.close()
@@ -0,0 +1,261 @@
+"""
+Reproject whole GeoJSON feature collections and shapefiles on the client.
+
+Asking Geoserver for a different CRS ('srs' in 'download_wfs_data') makes the server do the work, and 'reproject' in
+reproject_point.py does one point at a time. Here we:
+* handle every GeoJSON geometry type, including GeometryCollections.
+* pull every coordinate out of a batch of features and transform them with a single pyproj call.
+* split big collections into chunks and spread them over a process pool, so the work scales with the number of cores.
+* update the CRS so the result can go straight to 'write_spatial'.
+"""
+
+# If any of these imports fail, it's likely to be because you haven't installed the appropriate library.
+try:
+    import os
+    import re
+    from concurrent.futures import ProcessPoolExecutor
+    import fiona
+    from fiona.crs import from_epsg
+    import pyproj
+except Exception as e:
+    print(f"{e}")
+    quit(1)
+
+# Below this many features it isn't worth starting a process pool.
+DEFAULT_CHUNK_SIZE = 5000
+
+# How deep the positions are nested for each geometry type.
+COORDINATE_DEPTH = {
+    "Point": 0,
+    "MultiPoint": 1,
+    "LineString": 1,
+    "MultiLineString": 2,
+    "Polygon": 2,
+    "MultiPolygon": 3
+}
+
+# Each worker process builds its transformer once and keeps it here.
+_worker_transformer = None
+
+
+def epsg_from_collection(geojson_data, default=4326):
+    """
+    Work out the EPSG code of a FeatureCollection from its 'crs' member, e.g. Geoserver's
+    {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::29903"}}. GeoJSON without one is WGS84.
+
+    :param geojson_data: FeatureCollection as dict
+    :param default: EPSG code to use if there's no 'crs' member
+    :return: EPSG code as int
+    """
+    name = ((geojson_data.get("crs") or {}).get("properties") or {}).get("name", "")
+    found = re.search(r"EPSG:+(\d+)", name)
+    return int(found.group(1)) if found else default
+
+
+def _collect(geometry, positions):
+    # Append every position in the geometry to 'positions'.
+    if not geometry:
+        return
+    if geometry["type"] == "GeometryCollection":
+        for member in geometry["geometries"]:
+            _collect(member, positions)
+        return
+    pending = [(geometry["coordinates"], COORDINATE_DEPTH[geometry["type"]])]
+    while pending:
+        coordinates, depth = pending.pop()
+        if depth == 0:
+            if coordinates:
+                positions.append(coordinates)
+        else:
+            pending.extend((c, depth - 1) for c in reversed(coordinates))
+
+
+def _rebuild(coordinates, depth, transformed):
+    # Same nesting as 'coordinates' but with positions taken, in order, from the 'transformed' iterator.
+    if depth == 0:
+        return next(transformed) if coordinates else coordinates
+    return [_rebuild(c, depth - 1, transformed) for c in coordinates]
+
+
+def _rebuild_geometry(geometry, transformed):
+    if not geometry:
+        return geometry
+    if geometry["type"] == "GeometryCollection":
+        members = [_rebuild_geometry(member, transformed) for member in geometry["geometries"]]
+        return dict(geometry, geometries=members)
+    coordinates = _rebuild(geometry["coordinates"], COORDINATE_DEPTH[geometry["type"]], transformed)
+    rebuilt = dict(geometry, coordinates=coordinates)
+    rebuilt.pop("bbox", None)
+    return rebuilt
+
+
+def reproject_with_transformer(features, transformer):
+    """
+    Reproject a list of GeoJSON features. All the coordinates go through the transformer in one call.
+
+    :param features: list of GeoJSON features as dicts
+    :param transformer: pyproj Transformer with always_xy=True
+    :return: list of new features, the originals aren't changed
+    """
+    positions = []
+    for feature in features:
+        _collect(feature.get("geometry"), positions)
+    if not positions:
+        return [dict(feature) for feature in features]
+
+    xs = [p[0] for p in positions]
+    ys = [p[1] for p in positions]
+    if any(len(p) > 2 for p in positions):
+        zs = [p[2] if len(p) > 2 else 0.0 for p in positions]
+        new_xs, new_ys, new_zs = transformer.transform(xs, ys, zs)
+        transformed = iter([[x, y, z] if len(p) > 2 else [x, y]
+                            for p, x, y, z in zip(positions, new_xs, new_ys, new_zs)])
+    else:
+        new_xs, new_ys = transformer.transform(xs, ys)
+        transformed = iter([[x, y] for x, y in zip(new_xs, new_ys)])
+
+    reprojected = []
+    for feature in features:
+        new_feature = dict(feature)
+        new_feature["geometry"] = _rebuild_geometry(feature.get("geometry"), transformed)
+        new_feature.pop("bbox", None)
+        reprojected.append(new_feature)
+
+    return reprojected
+
+
+def _init_worker(source_epsg, target_epsg):
+    global _worker_transformer
+    _worker_transformer = pyproj.Transformer.from_crs(int(source_epsg), int(target_epsg), always_xy=True)
+
+
+def _reproject_chunk(features):
+    return reproject_with_transformer(features, _worker_transformer)
+
+
+def reproject_features(features, source_epsg, target_epsg, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reproject a list of GeoJSON features, in parallel if there are enough of them.
+
+    :param features: list of GeoJSON features as dicts
+    :param source_epsg: EPSG code of the features
+    :param target_epsg: EPSG code we want
+    :param processes: number of worker processes, defaults to the number of CPUs. 1 means don't use a pool.
+    :param chunk_size: features per chunk sent to a worker
+    :return: list of new features in the same order
+    """
+    features = list(features)
+    processes = processes or os.cpu_count() or 1
+    if int(source_epsg) == int(target_epsg):
+        return [dict(feature) for feature in features]
+    if processes == 1 or len(features) <= chunk_size:
+        transformer = pyproj.Transformer.from_crs(int(source_epsg), int(target_epsg), always_xy=True)
+        return reproject_with_transformer(features, transformer)
+
+    chunks = [features[i:i + chunk_size] for i in range(0, len(features), chunk_size)]
+    reprojected = []
+    with ProcessPoolExecutor(max_workers=min(processes, len(chunks)), initializer=_init_worker,
+                             initargs=(source_epsg, target_epsg)) as executor:
+        for chunk in executor.map(_reproject_chunk, chunks):
+            reprojected.extend(chunk)
+
+    return reprojected
+
+
+def _bounds(features):
+    positions = []
+    for feature in features:
+        _collect(feature.get("geometry"), positions)
+    if not positions:
+        return None
+    xs = [p[0] for p in positions]
+    ys = [p[1] for p in positions]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def reproject_feature_collection(geojson_data, target_epsg, source_epsg=None, processes=None,
+                                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reproject a GeoJSON FeatureCollection, e.g. result["geojson_data"] from 'download_wfs_data'. The 'crs' member is
+    set to the target CRS and any 'bbox' is recalculated.
+
+    :param geojson_data: FeatureCollection as dict
+    :param target_epsg: EPSG code we want
+    :param source_epsg: EPSG code of the data. If None we take it from the 'crs' member.
+    :param processes: number of worker processes, see 'reproject_features'
+    :param chunk_size: features per chunk, see 'reproject_features'
+    :return: new FeatureCollection as dict
+    """
+    source_epsg = source_epsg or epsg_from_collection(geojson_data)
+    features = reproject_features(geojson_data.get("features", []), source_epsg, target_epsg,
+                                  processes=processes, chunk_size=chunk_size)
+
+    collection = dict(geojson_data)
+    collection["features"] = features
+    collection["crs"] = {"type": "name", "properties": {"name": f"urn:ogc:def:crs:EPSG::{int(target_epsg)}"}}
+    if "bbox" in collection:
+        collection["bbox"] = _bounds(features)
+
+    return collection
+
+
+def reproject_wfs_result(result, target_epsg, source_epsg=None, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reproject the dictionary returned by 'download_wfs_data'. As well as the schema and GeoJSON we return 'crs', the
+    EPSG code, which is what 'write_spatial' expects, e.g.
+
+        reprojected = reproject_wfs_result(result, 2157)
+        write_spatial(file, directory, reprojected["geojson_data"]["features"], driver="GPKG",
+                      crs=reprojected["crs"], schema=reprojected["schema"])
+
+    :param result: dict with 'schema' and 'geojson_data'
+    :param target_epsg: EPSG code we want
+    :param source_epsg: EPSG code of the data. If None we take it from the GeoJSON.
+    :return: dict with 'schema', 'geojson_data' and 'crs'
+    """
+    return {
+        "schema": result["schema"],
+        "geojson_data": reproject_feature_collection(result["geojson_data"], target_epsg, source_epsg=source_epsg,
+                                                     processes=processes, chunk_size=chunk_size),
+        "crs": int(target_epsg)
+    }
+
+
+def reproject_shapefile(source, target, target_epsg, source_epsg=None, processes=None,
+                        chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reproject a shapefile (or anything else Fiona can read and write) to a new file.
+
+    :param source: path of the file to read
+    :param target: path of the file to write, using the same driver as the source
+    :param target_epsg: EPSG code we want
+    :param source_epsg: EPSG code of the source. If None we take it from the file.
+    :return: target
+    """
+    with fiona.open(source, "r") as fh:
+        meta = fh.meta
+        if not source_epsg:
+            source_epsg = pyproj.CRS.from_wkt(fh.crs_wkt).to_epsg()
+            if not source_epsg:
+                raise ValueError(f"Couldn't find an EPSG code for '{source}', please supply 'source_epsg'.")
+        features = [feature if isinstance(feature, dict) else feature.__geo_interface__ for feature in fh]
+
+    features = reproject_features(features, source_epsg, target_epsg, processes=processes, chunk_size=chunk_size)
+
+    meta.pop("crs_wkt", None)
+    meta["crs"] = from_epsg(int(target_epsg))
+    with fiona.open(target, "w", **meta) as fh:
+        fh.writerecords(features)
+
+    return target
+
+
+if __name__ == "__main__":
+    # Reproject the counties from ITM to Irish Grid and back again.
+    from utilities.download_from_geoserver import download_wfs_data
+
+    counties = download_wfs_data(workspace="census2011", dataset="counties", srs=2157)
+    irish_grid = reproject_wfs_result(counties, 29903)
+    back_again = reproject_wfs_result(irish_grid, 2157)
+    print(irish_grid["geojson_data"]["features"][0]["geometry"]["coordinates"][0][0][:2])
+    print(back_again["geojson_data"]["features"][0]["geometry"]["coordinates"][0][0][:2])
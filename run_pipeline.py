@@ -0,0 +1,501 @@
+"""
+Run a download -> transform -> write job described in a JSON or YAML file.
+
+Instead of a hand-written script that downloads everything, then reprojects everything, then writes everything, a job
+file lists sources, filters, transforms and sinks. Each of these runs as its own stage and the stages are joined by
+bounded queues carrying batches of features, so downloading, transforming and writing overlap and memory use is capped.
+WFS sources are downloaded a page at a time and each page is passed on as soon as it arrives. CPU-heavy stages
+(reprojection) use a process pool; everything else runs on threads. Progress is reported per stage.
+
+An example job file:
+
+    {
+        "name": "towns",
+        "batch_size": 1000,
+        "queue_size": 4,
+        "sources": [
+            {"type": "wfs", "workspace": "TUDublin", "dataset": "geonames_ie", "srs": 2157,
+             "filter_expression": "featurecode = 'PPL'"}
+        ],
+        "filters": [
+            {"property": "population", "op": ">", "value": 5000}
+        ],
+        "transforms": [
+            {"type": "reproject", "target_epsg": 29903, "processes": 4}
+        ],
+        "sinks": [
+            {"driver": "GPKG", "directory": "output", "file": "towns"}
+        ]
+    }
+
+Sources are 'wfs' (the arguments of 'iter_wfs_pages', or of 'download_wfs_data' if you give a 'cache_directory') or
+'file' (anything Fiona can read, with 'path'). Every source must have the same properties as the first; a source in a
+different CRS is reprojected to the first source's CRS as it's read. Transforms
+are 'reproject' (target_epsg, optional source_epsg and processes) and 'geocode' (address_property, optional gazetteer
+source and min_similarity). Sinks take 'driver', 'directory', 'file' and optionally 'crs' and 'schema' to override what
+came through.
+
+Run it with 'python run_pipeline.py job.json'.
+"""
+
+# If any of these imports fail, it's likely to be because you haven't installed the appropriate library.
+try:
+    import json
+    import os
+    import queue
+    import sys
+    import threading
+    import time
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    import fiona
+    from fiona.crs import from_epsg
+    import pyproj
+    from utilities.download_from_geoserver import download_wfs_data, iter_wfs_pages
+    import utilities.fiona_supported_drivers as fsd
+    from utilities.gazetteer import Gazetteer
+    from utilities.geopy_nominatim import geocode_address
+    from utilities.reproject_features import epsg_from_collection, reproject_features, _init_worker, _reproject_chunk
+except Exception as e:
+    print(f"{e}")
+    quit(1)
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_QUEUE_SIZE = 4
+DEFAULT_PROGRESS_INTERVAL = 5.0
+
+# Marks the end of the stream in a queue.
+_END = object()
+
+FILTER_OPERATORS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    "in": lambda a, b: a in b,
+    "not in": lambda a, b: a not in b,
+    "is null": lambda a, b: a is None,
+    "not null": lambda a, b: a is not None
+}
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+def load_job(path):
+    """
+    Read a job file. Files ending in .yaml or .yml need PyYAML, everything else is read as JSON.
+
+    :param path: job file
+    :return: job as dict
+    """
+    with open(path, "r", encoding="utf-8") as fh:
+        if path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML isn't installed so YAML job files can't be read. Use JSON or 'pip install "
+                                 "pyyaml'.")
+            return yaml.safe_load(fh)
+        return json.load(fh)
+
+
+def _batches(features, size):
+    batch = []
+    for feature in features:
+        batch.append(feature)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Stage(threading.Thread):
+    """
+    One step in a pipeline, running on its own thread. It takes batches from 'inbound', processes them and puts the
+    results on 'outbound'. 'pipeline.context' is shared by all stages and holds the schema and CRS of the data flowing
+    through; a stage that changes either updates it before passing on its first batch.
+    """
+
+    def __init__(self, name, pipeline):
+        super().__init__(name=name, daemon=True)
+        self.pipeline = pipeline
+        self.inbound = None
+        self.outbound = None
+        self.stats = {"stage": name, "batches": 0, "features_in": 0, "features_out": 0, "seconds": 0.0,
+                      "done": False}
+
+    def get(self):
+        while True:
+            if self.pipeline.abort.is_set():
+                raise PipelineAborted()
+            try:
+                return self.inbound.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def put(self, batch):
+        self.stats["batches"] += 1
+        self.stats["features_out"] += len(batch)
+        self._send(batch)
+
+    def _send(self, item):
+        # Never block for good: if another stage has failed, nobody will empty this queue.
+        while True:
+            if self.pipeline.abort.is_set():
+                raise PipelineAborted()
+            try:
+                self.outbound.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def inbound_batches(self):
+        while True:
+            batch = self.get()
+            if batch is _END:
+                return
+            self.stats["features_in"] += len(batch)
+            yield batch
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.produce()
+            if self.outbound:
+                self._send(_END)
+        except PipelineAborted:
+            pass
+        except (Exception, SystemExit) as e:
+            # Most of our helpers print the error and quit(), which only ends this thread, so catch that too.
+            if isinstance(e, SystemExit):
+                e = RuntimeError(f"exited with code {e.code}, see the message printed above")
+            self.pipeline.errors.append((self.name, e))
+            self.pipeline.abort.set()
+        finally:
+            self.stats["seconds"] = time.perf_counter() - start
+            self.stats["done"] = True
+
+    def produce(self):
+        for batch in self.inbound_batches():
+            batch = self.process(batch)
+            if batch:
+                self.put(batch)
+
+    def process(self, batch):
+        return batch
+
+
+class SourceStage(Stage):
+    """
+    Read each source in turn and pass its features on in batches. The first source sets the schema and CRS for the
+    pipeline.
+    """
+
+    # Arguments of 'iter_wfs_pages'.
+    WFS_ARGUMENTS = ("host", "workspace", "dataset", "srs", "filter_expression", "property_list", "thresholds")
+
+    def __init__(self, name, pipeline, specs):
+        super().__init__(name, pipeline)
+        self.specs = specs
+        self.schema = None
+        self.crs = None
+
+    def produce(self):
+        for spec in self.specs:
+            spec = dict(spec)
+            source_type = spec.pop("type", "wfs")
+            if source_type == "wfs":
+                self._emit(*self._read_wfs(spec))
+            elif source_type == "file":
+                # Fiona reads lazily so big files are streamed rather than loaded.
+                with fiona.open(spec["path"], "r") as fh:
+                    schema = {"geometry": fh.schema["geometry"], "properties": dict(fh.schema["properties"])}
+                    features = (f if isinstance(f, dict) else f.__geo_interface__ for f in fh)
+                    self._emit(schema, pyproj.CRS.from_wkt(fh.crs_wkt).to_epsg(), features)
+            else:
+                raise ValueError(f"Unknown source type '{source_type}'.")
+
+    @classmethod
+    def _read_wfs(cls, spec):
+        if spec.get("output_format", "application/json") != "application/json":
+            raise ValueError("WFS sources must use output_format 'application/json'.")
+        if spec.get("cache_directory"):
+            # Probably already cached, in which case loading it all is quicker than paging through Geoserver.
+            result = download_wfs_data(**spec)
+            schema, pages = result["schema"], iter([result["geojson_data"]])
+        else:
+            schema, pages = iter_wfs_pages(**{k: v for k, v in spec.items() if k in cls.WFS_ARGUMENTS})
+        # Without an 'srs' we only know the CRS once the first page is in.
+        first = next(pages, {"features": []})
+        crs = int(spec["srs"]) if spec.get("srs") else epsg_from_collection(first)
+
+        def features():
+            yield from first["features"]
+            for page in pages:
+                yield from page["features"]
+
+        return schema, crs, features()
+
+    def _emit(self, schema, crs, features):
+        properties = fsd.fiona_property_types(schema["properties"])
+        if self.schema is None:
+            self.schema, self.crs = dict(schema, properties=properties), crs
+            self.pipeline.context["schema"] = self.schema
+            self.pipeline.context["crs"] = crs
+        elif properties != self.schema["properties"]:
+            raise ValueError(f"Sources have different properties: {self.schema['properties']} and {properties}.")
+
+        for batch in _batches(features, self.pipeline.batch_size):
+            self.stats["features_in"] += len(batch)
+            if crs != self.crs:
+                batch = reproject_features(batch, crs, self.crs, processes=1)
+            self.put(batch)
+
+
+class FilterStage(Stage):
+    def __init__(self, name, pipeline, specs):
+        super().__init__(name, pipeline)
+        self.tests = []
+        for spec in specs:
+            if spec["op"] not in FILTER_OPERATORS:
+                raise ValueError(f"Unknown filter operator '{spec['op']}'.")
+            self.tests.append((spec["property"], FILTER_OPERATORS[spec["op"]], spec.get("value")))
+
+    def process(self, batch):
+        return [feature for feature in batch
+                if all(test((feature.get("properties") or {}).get(name), value) for name, test, value in self.tests)]
+
+
+class ReprojectStage(Stage):
+    """
+    Reprojection is pure CPU work so batches are handed to a process pool. We keep a few batches in flight per worker
+    and pass results on in their original order.
+    """
+
+    def __init__(self, name, pipeline, spec):
+        super().__init__(name, pipeline)
+        self.target_epsg = int(spec["target_epsg"])
+        self.source_epsg = spec.get("source_epsg")
+        self.processes = spec.get("processes") or os.cpu_count() or 1
+
+    def produce(self):
+        # The pool is started with the first batch, by which time the source has told us its CRS. Each worker builds
+        # its transformer once, see reproject_features.py.
+        pending = deque()
+        executor = None
+        try:
+            for batch in self.inbound_batches():
+                if executor is None:
+                    if self.source_epsg is None:
+                        self.source_epsg = self.pipeline.context.get("crs") or 4326
+                    executor = ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker,
+                                                   initargs=(self.source_epsg, self.target_epsg))
+                pending.append(executor.submit(_reproject_chunk, batch))
+                while len(pending) >= 2 * self.processes:
+                    self._emit(pending.popleft().result())
+            while pending:
+                self._emit(pending.popleft().result())
+        finally:
+            if executor:
+                executor.shutdown()
+
+    def _emit(self, batch):
+        self.pipeline.context["crs"] = self.target_epsg
+        self.put(batch)
+
+
+class GeocodeStage(Stage):
+    """
+    Give each feature a point geometry (WGS84) by geocoding one of its properties. Uses a local gazetteer first if the
+    spec names a source for one, otherwise Nominatim.
+    """
+
+    def __init__(self, name, pipeline, spec):
+        super().__init__(name, pipeline)
+        self.address_property = spec["address_property"]
+        self.gazetteer_spec = spec.get("gazetteer")
+        self.min_similarity = spec.get("min_similarity")
+        self.gazetteer = None
+
+    def produce(self):
+        if self.gazetteer_spec:
+            spec = dict(self.gazetteer_spec)
+            self.gazetteer = Gazetteer.from_wfs_result(download_wfs_data(**spec), epsg=spec.get("srs") or 4326)
+        super().produce()
+
+    def process(self, batch):
+        geocoded = []
+        for feature in batch:
+            address = (feature.get("properties") or {}).get(self.address_property)
+            response = geocode_address(address, gazetteer=self.gazetteer, min_similarity=self.min_similarity)
+            if "result" not in response["body"]:
+                continue
+            result = response["body"]["result"]
+            geocoded.append(dict(feature, geometry={"type": "Point",
+                                                    "coordinates": [float(result["lon"]), float(result["lat"])]}))
+        context = self.pipeline.context
+        context["crs"] = 4326
+        if "schema" in context:
+            context["schema"] = dict(context["schema"], geometry="Point")
+        return geocoded
+
+
+class SinkStage(Stage):
+    """
+    Write batches as they arrive. Each sink file is opened when the first batch turns up (by which time we know the
+    schema and CRS) and stays open until the end.
+    """
+
+    def __init__(self, name, pipeline, specs):
+        super().__init__(name, pipeline)
+        self.specs = specs
+        self.targets = []
+
+    def _open(self, spec):
+        context = self.pipeline.context
+        driver = spec["driver"]
+        if driver not in fsd.file_extensions or not fsd.file_extensions[driver]:
+            raise ValueError(f"Invalid driver '{driver}'.")
+        schema = dict(spec.get("schema") or context["schema"])
+        schema["properties"] = fsd.fiona_property_types(schema["properties"])
+        schema.pop("geometry_column", None)
+        target = os.path.join(spec["directory"], f"{spec['file']}.{fsd.file_extensions[driver]}")
+        return fiona.open(target, "w", driver=driver, crs=from_epsg(int(spec.get("crs") or context["crs"])),
+                          schema=schema)
+
+    def produce(self):
+        handles = []
+        try:
+            for batch in self.inbound_batches():
+                if not handles:
+                    handles = [self._open(spec) for spec in self.specs]
+                for fh in handles:
+                    fh.writerecords(batch)
+                self.stats["batches"] += 1
+                self.stats["features_out"] += len(batch)
+        finally:
+            for fh in handles:
+                fh.close()
+
+
+class Pipeline:
+    """
+    A job turned into connected stages.
+
+    :param job: job as dict, see the top of this file.
+    :param progress: function called with a list of per-stage stats every 'progress_interval' seconds and at the end.
+    Defaults to printing them.
+    """
+
+    def __init__(self, job, progress=None):
+        self.name = job.get("name", "pipeline")
+        self.batch_size = job.get("batch_size", DEFAULT_BATCH_SIZE)
+        self.queue_size = job.get("queue_size", DEFAULT_QUEUE_SIZE)
+        self.progress_interval = job.get("progress_interval", DEFAULT_PROGRESS_INTERVAL)
+        self.progress = progress or print_progress
+        self.context = {}
+        self.errors = []
+        self.abort = threading.Event()
+
+        if not job.get("sources"):
+            raise ValueError("A job needs at least one source.")
+        if not job.get("sinks"):
+            raise ValueError("A job needs at least one sink.")
+
+        self.stages = [SourceStage("source", self, job["sources"])]
+        if job.get("filters"):
+            self.stages.append(FilterStage("filter", self, job["filters"]))
+        for number, spec in enumerate(job.get("transforms") or [], start=1):
+            if spec["type"] == "reproject":
+                self.stages.append(ReprojectStage(f"reproject-{number}", self, spec))
+            elif spec["type"] == "geocode":
+                self.stages.append(GeocodeStage(f"geocode-{number}", self, spec))
+            else:
+                raise ValueError(f"Unknown transform type '{spec['type']}'.")
+        self.stages.append(SinkStage("sink", self, job["sinks"]))
+
+        for upstream, downstream in zip(self.stages, self.stages[1:]):
+            upstream.outbound = downstream.inbound = queue.Queue(maxsize=self.queue_size)
+
+    def stats(self):
+        stats = []
+        for stage in self.stages:
+            entry = dict(stage.stats)
+            entry["queued"] = stage.inbound.qsize() if stage.inbound else 0
+            entry["features_per_second"] = entry["features_out"] / entry["seconds"] if entry["seconds"] else None
+            stats.append(entry)
+        return stats
+
+    def run(self):
+        """
+        Run every stage and wait for them to finish.
+
+        :return: list of per-stage stats
+        """
+        for stage in self.stages:
+            stage.start()
+        started = time.perf_counter()
+        while True:
+            deadline = time.perf_counter() + self.progress_interval
+            for stage in self.stages:
+                stage.join(timeout=max(0.0, deadline - time.perf_counter()))
+            if not any(stage.is_alive() for stage in self.stages):
+                break
+            for stage in self.stages:
+                if not stage.stats["done"]:
+                    stage.stats["seconds"] = time.perf_counter() - started
+            self.progress(self.stats())
+
+        stats = self.stats()
+        self.progress(stats)
+        if self.errors:
+            name, error = self.errors[0]
+            raise RuntimeError(f"Stage '{name}' failed: {error}") from error
+        return stats
+
+
+def print_progress(stats):
+    """
+    Default progress report, one line per stage.
+
+    :param stats: from 'Pipeline.stats'
+    """
+    for entry in stats:
+        rate = f"{entry['features_per_second']:.0f}/s" if entry["features_per_second"] else "-"
+        state = "done" if entry["done"] else "running"
+        print(f"{entry['stage']:12} {state:8} in={entry['features_in']:<9} out={entry['features_out']:<9} "
+              f"queued={entry['queued']:<3} {rate}")
+    print("-" * 60)
+
+
+def run_job(job, progress=None):
+    """
+    Run a job.
+
+    :param job: path to a JSON or YAML job file, or the job as a dict.
+    :param progress: see 'Pipeline'
+    :return: list of per-stage stats
+    """
+    if isinstance(job, str):
+        job = load_job(job)
+    return Pipeline(job, progress=progress).run()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: python {os.path.basename(__file__)} job.json")
+        quit(2)
+    try:
+        run_job(sys.argv[1])
+    except Exception as e:
+        print(f"{e}")
+        quit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Keep a local copy of a Geoserver dataset up to date without downloading all of it every time.
+
+The first sync downloads the whole dataset. After that, 'sync_wfs_data' only deals with what has changed:
+* "timestamp" mode - the layer has an attribute that records when a feature was last changed. We remember the largest
+  value we've seen and only ask for features with that value or later (a CQL filter). Deletions are found by fetching
+  just the feature ids, which is far smaller than the features themselves.
+* "hash" mode - for layers without such an attribute. We keep a hash of every feature and compare. This still downloads
+  the layer but tells you exactly what was inserted, updated and deleted.
+
+The local copy is a parsed dataset file (see parsed_dataset_cache.py) and the sync state is a small JSON file, both
+kept in a directory you choose. This is deliberately not a 'CacheManager': a cache can evict entries to stay under its
+quota, and losing the local copy would quietly turn the next sync into a full download.
+
+What we save is network traffic. The local copy is still read in full and, if anything changed, written again in full,
+so local work grows with the size of the dataset rather than the size of the change. The write is skipped when nothing
+has changed.
+"""
+
+# If any of these imports fail, it's likely to be because you haven't installed the appropriate library.
+try:
+    import datetime
+    import hashlib
+    import json
+    import os
+    import threading
+    import requests
+    from utilities.download_from_geoserver import HOST, download_wfs_data, build_getfeature_url, combine_filters
+    import utilities.parsed_dataset_cache as pdc
+except Exception as e:
+    print(f"{e}")
+    quit(1)
+
+SYNC_MODES = ("timestamp", "hash")
+
+
+def feature_hash(feature):
+    """
+    Hash of a feature's geometry and properties, used to spot changes.
+
+    :param feature: GeoJSON feature as dict
+    :return: hex string
+    """
+    content = json.dumps([feature.get("geometry"), feature.get("properties")], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def _cql_literal(value):
+    # Numbers go in as they are, everything else (dates, times, text) as a quoted string.
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _feature_id(feature, id_property):
+    if id_property:
+        value = (feature.get("properties") or {}).get(id_property)
+        if value is None:
+            raise ValueError(f"Feature has no '{id_property}', which is needed to identify it.")
+        return str(value)
+    if feature.get("id") is None:
+        raise ValueError("Features have no 'id', please supply 'id_property'.")
+    return str(feature["id"])
+
+
+def fetch_feature_ids(host=HOST, workspace=None, dataset=None, filter_expression=None, id_property=None,
+                      light_property=None):
+    """
+    Get the ids of every feature matching a filter without downloading geometries.
+
+    :param light_property: a small attribute to ask for instead of everything, e.g. the update attribute. If we don't
+    ask for at least one attribute Geoserver sends them all.
+    :param id_property: attribute holding the id, if not the WFS feature id.
+    :return: set of ids as str
+    """
+    properties = [p for p in (id_property, light_property) if p]
+    url = build_getfeature_url(host, workspace, dataset, "application/json", None, filter_expression, properties)
+    response = requests.get(url)
+    if not 200 <= response.status_code <= 299:
+        raise ValueError(f"Bad status code: {response.status_code}")
+    return {_feature_id(feature, id_property) for feature in response.json().get("features", [])}
+
+
+def _load_state(path):
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def _save_state(path, state):
+    # Write then rename, so a sync that stops half way never leaves a broken state file.
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as fh:
+        json.dump(state, fh)
+    os.replace(temp_path, path)
+
+
+def sync_wfs_data(directory, host=HOST, workspace=None, dataset=None, srs=None, filter_expression=None,
+                  property_list=None, mode="timestamp", update_attribute=None, id_property=None, detect_deletes=True):
+    """
+    Bring the local copy of a dataset up to date. Arguments are the same as 'download_wfs_data' apart from these:
+
+    :param directory: where the local copy and sync state are kept. Created if it doesn't exist. Nothing else should
+    clean it up; if the files go, the next sync is a full download.
+    :param mode: "timestamp" or "hash", see above.
+    :param update_attribute: timestamp mode only. The attribute that records when a feature last changed.
+    :param id_property: attribute that identifies a feature, if the WFS feature id isn't stable.
+    :param detect_deletes: timestamp mode only. Fetch the current ids to find deleted features.
+    :return: dict with
+    * result - the up to date dataset, the same as 'download_wfs_data' returns for JSON.
+    * inserted, updated, deleted - lists of feature ids.
+    * full - True if this was a full download (first sync).
+    * path - file holding the local copy. It's rewritten in full whenever anything has changed.
+    """
+    if mode not in SYNC_MODES:
+        raise ValueError(f"Sync mode must be one of {SYNC_MODES}")
+    if mode == "timestamp" and not update_attribute:
+        raise ValueError("Timestamp mode needs an 'update_attribute'.")
+    if isinstance(property_list, str):
+        property_list = property_list.split(",")
+    if property_list:
+        # We can't do without the attributes that identify a feature and say when it changed.
+        needed = [p for p in (id_property, update_attribute if mode == "timestamp" else None) if p]
+        property_list = list(property_list) + [p for p in needed if p not in property_list]
+
+    os.makedirs(directory, exist_ok=True)
+    key = pdc.dataset_cache_key(host, workspace, dataset, filter_expression, property_list, srs)
+    state_path = os.path.join(directory, f"{key}.json")
+    data_path = os.path.join(directory, f"{key}.{pdc.FILE_EXTENSION}")
+
+    state = _load_state(state_path)
+    if state and (state.get("mode") != mode or not os.path.exists(data_path)):
+        # Different mode from last time, or the local copy has gone - start again.
+        state = None
+
+    query = dict(host=host, workspace=workspace, dataset=dataset, srs=srs, property_list=property_list)
+    full = state is None
+    if full or mode == "hash":
+        changed = download_wfs_data(filter_expression=filter_expression, **query)
+    else:
+        since = f"{update_attribute} >= {_cql_literal(state['last_value'])}"
+        changed = download_wfs_data(filter_expression=combine_filters(filter_expression, since), **query)
+
+    if full:
+        local = {"schema": changed["schema"], "geojson_data": dict(changed["geojson_data"], features=[])}
+        hashes = {}
+    else:
+        local = pdc.read_parsed_dataset(data_path)
+        hashes = state["hashes"]
+
+    features = {_feature_id(f, id_property): f for f in local["geojson_data"]["features"]}
+    inserted, updated, deleted = [], [], []
+
+    incoming = {}
+    for feature in changed["geojson_data"]["features"]:
+        feature_id = _feature_id(feature, id_property)
+        incoming[feature_id] = feature
+        digest = feature_hash(feature)
+        if feature_id not in features:
+            inserted.append(feature_id)
+        elif hashes.get(feature_id) != digest:
+            updated.append(feature_id)
+        else:
+            continue
+        features[feature_id] = feature
+        hashes[feature_id] = digest
+
+    if not full:
+        if mode == "hash":
+            current_ids = set(incoming)
+        elif detect_deletes:
+            current_ids = fetch_feature_ids(host, workspace, dataset, filter_expression, id_property,
+                                            update_attribute)
+        else:
+            current_ids = None
+        if current_ids is not None:
+            deleted = [feature_id for feature_id in features if feature_id not in current_ids]
+            for feature_id in deleted:
+                del features[feature_id]
+                hashes.pop(feature_id, None)
+
+    local["geojson_data"]["features"] = list(features.values())
+    if changed["geojson_data"].get("crs"):
+        local["geojson_data"]["crs"] = changed["geojson_data"]["crs"]
+    for member in ("totalFeatures", "numberMatched", "numberReturned", "bbox"):
+        local["geojson_data"].pop(member, None)
+
+    new_state = {
+        "mode": mode,
+        "update_attribute": update_attribute,
+        "id_property": id_property,
+        "hashes": hashes,
+        "synced_at": datetime.datetime.now().isoformat()
+    }
+    if mode == "timestamp":
+        values = [(f.get("properties") or {}).get(update_attribute) for f in features.values()]
+        values = [v for v in values if v is not None]
+        new_state["last_value"] = max(values) if values else (state or {}).get("last_value")
+        if new_state["last_value"] is None:
+            # Nothing to compare against next time, so the next sync will be a full one.
+            new_state["mode"] = None
+
+    # Write the data first: if we stop half way, the old state just means the next sync repeats some work.
+    if full or inserted or updated or deleted:
+        pdc.write_parsed_dataset(data_path, local)
+    _save_state(state_path, new_state)
+
+    return {
+        "result": local,
+        "inserted": inserted,
+        "updated": updated,
+        "deleted": deleted,
+        "full": full,
+        "path": data_path
+    }
+
+
+if __name__ == "__main__":
+    # Sync the big towns in geonames_ie, comparing hashes as the layer has no update attribute.
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        for attempt in range(2):
+            summary = sync_wfs_data(directory, workspace="TUDublin", dataset="geonames_ie", mode="hash",
+                                    filter_expression="featurecode = 'PPL' AND population > 5000")
+            print(f"full={summary['full']} inserted={len(summary['inserted'])} updated={len(summary['updated'])} "
+                  f"deleted={len(summary['deleted'])}")
@@ -2,6 +2,7 @@ try:
     import fiona
     from fiona.crs import from_epsg
     import utilities.fiona_supported_drivers as fsd
+    import utilities.driver_capabilities as dc
     import os
 except Exception as e:
     print(f"{e}")
@@ -9,6 +10,15 @@ except Exception as e:
 
 
 def write_spatial(file=None, directory=None, data=None, **meta):
+    """
+    Write GeoJSON-like features to a spatial file with Fiona.
+
+    :param file: file name without extension, the extension comes from the driver.
+    :param directory: where to write the file, must exist.
+    :param data: iterable of features.
+    :param meta: Fiona metadata - driver, crs (EPSG code) and schema. Use driver="auto" to pick the fastest driver that
+    works on this machine (see driver_capabilities.py).
+    """
     try:
         if not data:
             raise ValueError(f"No data to write.")
@@ -20,16 +30,17 @@ def write_spatial(file=None, directory=None, data=None, **meta):
             raise ValueError(f"Missing CRS.")
         if "schema" not in meta:
             raise ValueError(f"Missing schema.")
+        meta["schema"] = dict(meta["schema"], properties=fsd.fiona_property_types(meta["schema"]["properties"]))
+        if meta["driver"] == "auto":
+            meta["driver"] = dc.choose_fastest_driver(meta["schema"].get("geometry", "Point"),
+                                                      properties=meta["schema"]["properties"])
         if meta["driver"] not in fsd.file_extensions:
             raise ValueError(f"Invalid driver.")
+        if not dc.can_write(meta["driver"]):
+            raise ValueError(f"Driver '{meta['driver']}' can't write files on this machine.")
 
         target = os.path.join(directory, f"{file}.{fsd.file_extensions[meta['driver']]}")
         meta["crs"] = from_epsg(meta["crs"])
-        for k, v in meta["schema"]["properties"].items():
-            if v == "string":
-                meta["schema"]["properties"][k] = "str"
-            elif v == "double":
-                meta["schema"]["properties"][k] = "float"
 
         with fiona.open(target, "w", **meta) as fh:
             for feature in data: